@@ -112,14 +112,8 @@ class NI6738AnalogCard(Sequencer, RuntimeDevice):
 
     def _program_sequence(self, sequence: TimedInstruction) -> None:
         logger.debug("Programmed ni6738")
-        values = np.concatenate(
-            self._values_from_instruction(sequence), axis=1, dtype=np.float64
-        )
+        values = self.compute_values(sequence)
 
-        if not values.shape[0] == self.channel_number:
-            raise ValueError(
-                f"Expected {self.channel_number} channels, got {values.shape[0]}"
-            )
         number_samples = values.shape[1]
         self._configure_timing(number_samples)
 
@@ -153,40 +147,85 @@ class NI6738AnalogCard(Sequencer, RuntimeDevice):
         self._task.timing.samp_clk_dig_fltr_min_pulse_width = float(time_step / 8)
         self._task.timing.samp_clk_dig_fltr_enable = True
 
+    def compute_values(self, sequence: TimedInstruction) -> np.ndarray:
+        """Compute the samples to send to the card for a sequence.
+
+        This doesn't access the card.
+
+        The card is clocked on changes, so a repeated step produces a single sample.
+
+        Returns:
+            An array with shape (channel_number, number of samples).
+        """
+
+        # Each instruction writes its samples directly in this buffer, so that the
+        # values are only copied once before being sent to the card.
+        values = np.empty(
+            (self.channel_number, self._number_of_samples(sequence)), dtype=np.float64
+        )
+        self._write_instruction_values(sequence, values)
+        if not np.all(np.isfinite(values)):
+            raise ValueError("Sequence contains non-finite values")
+        return values
+
     @singledispatchmethod
-    def _values_from_instruction(
-        self, instruction: TimedInstruction
-    ) -> list[np.ndarray]:
+    def _number_of_samples(self, instruction: TimedInstruction) -> int:
+        """Return the number of samples that an instruction writes."""
+
+        return len(instruction)
+
+    @_number_of_samples.register
+    def _(self, concatenate: Concatenated) -> int:
+        return sum(
+            self._number_of_samples(instruction)
+            for instruction in concatenate.instructions
+        )
+
+    @_number_of_samples.register
+    def _(self, repeat: Repeated) -> int:
+        return 1
+
+    @singledispatchmethod
+    def _write_instruction_values(
+        self, instruction: TimedInstruction, out: np.ndarray
+    ) -> None:
+        """Write the values of an instruction in a buffer.
+
+        Args:
+            instruction: The instruction to compute the values of.
+            out: The buffer to write the values in, with shape
+                (channel_number, number of samples of the instruction).
+        """
+
         raise NotImplementedError(
             f"Instruction with type {type(instruction)} is not supported"
         )
 
-    @_values_from_instruction.register
-    def _values_from_pattern(self, pattern: Pattern) -> list[np.ndarray]:
+    @_write_instruction_values.register
+    def _write_pattern_values(self, pattern: Pattern, out: np.ndarray) -> None:
         values = pattern.array
-        result = np.array([values[f"ch {ch}"] for ch in range(self.channel_number)])
-        if not np.all(np.isfinite(result)):
-            raise ValueError("Pattern contains non-finite values")
-        return [result]
-
-    @_values_from_instruction.register
-    def _values_from_ramp(self, ramp: Ramp):
-        return self._values_from_pattern(ramp.to_pattern())
-
-    @_values_from_instruction.register
-    def _(self, concatenate: Concatenated) -> list[np.ndarray]:
-        result = []
+        for ch in range(self.channel_number):
+            out[ch] = values[f"ch {ch}"]
+
+    @_write_instruction_values.register
+    def _write_ramp_values(self, ramp: Ramp, out: np.ndarray) -> None:
+        self._write_pattern_values(ramp.to_pattern(), out)
+
+    @_write_instruction_values.register
+    def _(self, concatenate: Concatenated, out: np.ndarray) -> None:
+        start = 0
         for instruction in concatenate.instructions:
-            result.extend(self._values_from_instruction(instruction))
-        return result
+            stop = start + self._number_of_samples(instruction)
+            self._write_instruction_values(instruction, out[:, start:stop])
+            start = stop
 
-    @_values_from_instruction.register
-    def _(self, repeat: Repeated) -> list[np.ndarray]:
+    @_write_instruction_values.register
+    def _(self, repeat: Repeated, out: np.ndarray) -> None:
         if len(repeat.instruction) != 1:
             raise NotImplementedError(
                 "Only one instruction is supported in a repeat block at the moment"
             )
-        return self._values_from_instruction(repeat.instruction.to_pattern())
+        self._write_instruction_values(repeat.instruction, out)
 
 
 class _ProgrammedSequence(ProgrammedSequence):
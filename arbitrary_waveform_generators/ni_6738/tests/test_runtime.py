@@ -0,0 +1,48 @@
+import decimal
+
+import numpy as np
+
+from caqtus.device.sequencer.trigger import ExternalClockOnChange, TriggerEdge
+from caqtus.shot_compilation.timed_instructions import (
+    Pattern,
+    Concatenated,
+    Repeated,
+)
+from caqtus_devices.arbitrary_waveform_generators.ni_6738.runtime import (
+    NI6738AnalogCard,
+)
+
+CHANNEL_NUMBER = 32
+
+
+def analog_pattern(values: list[float]) -> Pattern:
+    """Build a pattern where channel i outputs value + i at each step."""
+
+    dtype = np.dtype([(f"ch {channel}", np.float64) for channel in range(32)])
+    array = np.zeros(len(values), dtype=dtype)
+    for channel in range(CHANNEL_NUMBER):
+        array[f"ch {channel}"] = np.array(values) + channel
+    return Pattern.create_without_copy(array)
+
+
+def card() -> NI6738AnalogCard:
+    return NI6738AnalogCard(
+        name="ni6738",
+        device_id="Dev0",
+        time_step=decimal.Decimal(2500),
+        trigger=ExternalClockOnChange(edge=TriggerEdge.RISING),
+    )
+
+
+def test_repeated_step_is_a_single_sample():
+    sequence = Concatenated(
+        analog_pattern([0.0, 1.0, 2.0]), Repeated(1_000_000, analog_pattern([3.0]))
+    )
+
+    values = card().compute_values(sequence)
+
+    # The card only gets a clock edge when the value changes, so the repeated step
+    # is sent once.
+    assert values.shape == (CHANNEL_NUMBER, 4)
+    assert np.array_equal(values[0], [0.0, 1.0, 2.0, 3.0])
+    assert np.array_equal(values[5], [5.0, 6.0, 7.0, 8.0])
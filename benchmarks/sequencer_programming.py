@@ -0,0 +1,405 @@
+"""Benchmark of the time taken to program a shot on the sequencers.
+
+The benchmark generates synthetic instruction trees and times `program_sequence`
+for the Spincore PulseBlaster, the Swabian Pulse Streamer and the NI6738 analog
+card, without any hardware attached:
+
+* The PulseBlaster uses the simulated spinapi backend.
+* The Pulse Streamer uses the simulated device, that records the uploaded pulses.
+* The NI6738 computes the samples that would be written to the card.
+
+For each case, the wall time, the peak memory allocated during programming and
+the number of instructions, pulses or samples sent to the device are reported.
+
+The packages of the three devices must be installed in the environment.
+
+Usage:
+    python benchmarks/sequencer_programming.py [--repeat N] [--budget MS]
+        [--output results.json]
+
+The script exits with a non-zero status when one of the cases raises an error, or
+if a budget is given, when one of the cases takes longer than the budget to
+program, so that it can be used to catch regressions before deployment.
+"""
+
+from __future__ import annotations
+
+import abc
+import argparse
+import decimal
+import functools
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable
+from typing import Any
+
+import attrs
+import numpy as np
+
+from caqtus.shot_compilation.timed_instructions import (
+    TimedInstruction,
+    Pattern,
+    Concatenated,
+    Repeated,
+    Ramp,
+    stack_instructions,
+    with_name,
+)
+
+
+@attrs.define
+class BenchmarkResult:
+    device: str
+    case: str
+    wall_time: float
+    peak_memory: int
+    emitted: int
+    error: str = ""
+
+    def __str__(self) -> str:
+        if self.error:
+            return f"{self.device:<12} {self.case:<20} {self.error}"
+        return (
+            f"{self.device:<12} {self.case:<20} "
+            f"{self.wall_time * 1e3:10.2f} ms "
+            f"{self.peak_memory / 2**20:10.2f} MiB "
+            f"{self.emitted:12d} emitted"
+        )
+
+
+def digital_pattern(
+    channel_number: int, length: int, period: int, analog_channel_number: int = 0
+) -> Pattern:
+    """A pattern where channel i toggles every `period * (i + 1)` steps.
+
+    If analog channels are requested, they come after the digital channels and are
+    held at 0.
+    """
+
+    dtype = np.dtype(
+        [(f"ch {channel}", np.bool_) for channel in range(channel_number)]
+        + [
+            (f"ch {channel}", np.float64)
+            for channel in range(channel_number, channel_number + analog_channel_number)
+        ]
+    )
+    array = np.zeros(length, dtype=dtype)
+    steps = np.arange(length)
+    for channel in range(channel_number):
+        array[f"ch {channel}"] = (steps // (period * (channel + 1))) % 2 == 1
+    return Pattern.create_without_copy(array)
+
+
+def analog_pattern(channel_number: int, length: int) -> Pattern:
+    dtype = np.dtype(
+        [(f"ch {channel}", np.float64) for channel in range(channel_number)]
+    )
+    array = np.zeros(length, dtype=dtype)
+    steps = np.arange(length)
+    for channel in range(channel_number):
+        array[f"ch {channel}"] = np.sin(steps * (channel + 1) / length)
+    return Pattern.create_without_copy(array)
+
+
+def analog_ramp(channel_number: int, length: int) -> TimedInstruction:
+    return stack_instructions(
+        [
+            with_name(Ramp(0.0, float(channel), length), f"ch {channel}")
+            for channel in range(channel_number)
+        ]
+    )
+
+
+def digital_cases(
+    channel_number: int, analog_channel_number: int = 0
+) -> dict[str, Callable[[], TimedInstruction]]:
+    pattern = functools.partial(
+        digital_pattern, analog_channel_number=analog_channel_number
+    )
+
+    def long_pattern():
+        return pattern(channel_number, 100_000, period=7)
+
+    def deep_concatenated():
+        return Concatenated(
+            *(
+                pattern(channel_number, 20 + segment % 5, period=3)
+                for segment in range(500)
+            )
+        )
+
+    def nested_repeated():
+        inner = Repeated(50, pattern(channel_number, 4, period=1))
+        body = Concatenated(pattern(channel_number, 10, period=2), inner)
+        return Repeated(1_000, body)
+
+    def trigger_train():
+        return Repeated(100_000, pattern(channel_number, 2, period=1))
+
+    return {
+        "long_pattern": long_pattern,
+        "deep_concatenated": deep_concatenated,
+        "nested_repeated": nested_repeated,
+        "trigger_train": trigger_train,
+    }
+
+
+def analog_cases(channel_number: int) -> dict[str, Callable[[], TimedInstruction]]:
+    def long_pattern():
+        return analog_pattern(channel_number, 100_000)
+
+    def deep_concatenated():
+        return Concatenated(
+            *(analog_pattern(channel_number, 200) for _ in range(500))
+        )
+
+    def held_steps():
+        # The card is clocked on changes, so it only supports repetitions of a single
+        # step, that are used to hold a value.
+        return Concatenated(
+            *(
+                instruction
+                for _ in range(500)
+                for instruction in (
+                    analog_pattern(channel_number, 10),
+                    Repeated(1_000, analog_pattern(channel_number, 1)),
+                )
+            )
+        )
+
+    def long_ramp():
+        return analog_ramp(channel_number, 1_000_000)
+
+    return {
+        "long_pattern": long_pattern,
+        "deep_concatenated": deep_concatenated,
+        "held_steps": held_steps,
+        "long_ramp": long_ramp,
+    }
+
+
+class DeviceBench(abc.ABC):
+    """Program sequences on a device and count what is sent to the backend."""
+
+    name: str
+    channel_number: int
+
+    @abc.abstractmethod
+    def prepare(self) -> None:
+        """Bring the device to a fresh state before programming a sequence.
+
+        This is not timed, and makes sure that each call to `program` does the
+        full work instead of hitting a cache.
+        """
+
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def program(self, sequence: TimedInstruction) -> int:
+        """Program a sequence.
+
+        Returns:
+            The number of instructions, pulses or samples sent to the backend.
+        """
+
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SpincoreBench(DeviceBench):
+    name = "spincore"
+    channel_number = 24
+
+    def __init__(self):
+        from caqtus_devices.pulse_generators.spincore_pulse_blaster.runtime import (
+            SpincorePulseBlaster,
+            simulated_spinapi,
+        )
+
+        self._device_type = SpincorePulseBlaster
+        self._simulation = simulated_spinapi
+        self._device = None
+
+    def prepare(self) -> None:
+        self.close()
+        # Large enough to hold uncompressed programs, we want to measure the time
+        # spent programming and not fail on memory limits.
+        self._simulation.reset_simulation()
+        self._device = self._device_type(
+            name="spincore",
+            time_step=decimal.Decimal(50),
+            simulate=True,
+            memory_size=2**20,
+        )
+        self._device.__enter__()
+
+    def program(self, sequence: TimedInstruction) -> int:
+        self._device.program_sequence(sequence)
+        return self._simulation.get_board(0).write_count
+
+    def close(self) -> None:
+        if self._device is not None:
+            self._device.__exit__(None, None, None)
+            self._device = None
+
+
+class SwabianBench(DeviceBench):
+    name = "swabian"
+    channel_number = 8
+
+    def __init__(self):
+        from caqtus_devices.pulse_generators.swabian_instruments_pulse_streamer.runtime import (  # noqa: E501
+            SwabianPulseStreamer,
+            simulated_pulse_streamer,
+        )
+
+        self._device_type = SwabianPulseStreamer
+        self._simulation = simulated_pulse_streamer
+        self._device = None
+
+    def prepare(self) -> None:
+        self.close()
+        self._simulation.reset_simulation()
+        self._device = self._device_type(
+            name="swabian",
+            ip_address="127.0.0.1",
+            time_step=decimal.Decimal(1),
+            simulate=True,
+        )
+        self._device.__enter__()
+
+    def program(self, sequence: TimedInstruction) -> int:
+        self._device.program_sequence(sequence)
+        return self._simulation.get_device("127.0.0.1").uploaded_pulses
+
+    def close(self) -> None:
+        if self._device is not None:
+            self._device.__exit__(None, None, None)
+            self._device = None
+
+
+class NI6738Bench(DeviceBench):
+    name = "ni6738"
+    channel_number = 32
+
+    def __init__(self):
+        from caqtus.device.sequencer.trigger import ExternalClockOnChange, TriggerEdge
+        from caqtus_devices.arbitrary_waveform_generators.ni_6738.runtime import (
+            NI6738AnalogCard,
+        )
+
+        # The card is not initialized, only the samples that would be written to it
+        # are computed.
+        self._device = NI6738AnalogCard(
+            name="ni6738",
+            device_id="Dev0",
+            time_step=decimal.Decimal(2500),
+            trigger=ExternalClockOnChange(edge=TriggerEdge.RISING),
+        )
+
+    def prepare(self) -> None:
+        pass
+
+    def program(self, sequence: TimedInstruction) -> int:
+        return self._device.compute_values(sequence).shape[1]
+
+
+def run_case(
+    bench: DeviceBench, case: str, factory: Callable[[], TimedInstruction], repeat: int
+) -> BenchmarkResult:
+    sequence = factory()
+    try:
+        # Memory tracing slows down allocations, so the peak memory is measured on
+        # a separate run that is not timed.
+        bench.prepare()
+        tracemalloc.start()
+        try:
+            emitted = bench.program(sequence)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        wall_times = []
+        for _ in range(repeat):
+            bench.prepare()
+            start = time.perf_counter()
+            bench.program(sequence)
+            wall_times.append(time.perf_counter() - start)
+    except Exception as e:
+        return BenchmarkResult(
+            device=bench.name,
+            case=case,
+            wall_time=float("nan"),
+            peak_memory=0,
+            emitted=0,
+            error=f"{type(e).__name__}: {e}",
+        )
+    return BenchmarkResult(
+        device=bench.name,
+        case=case,
+        wall_time=statistics.median(wall_times),
+        peak_memory=peak_memory,
+        emitted=emitted,
+    )
+
+
+def run_benchmarks(repeat: int) -> list[BenchmarkResult]:
+    results = []
+    benches: list[tuple[type[DeviceBench], Callable[[int], dict[str, Any]]]] = [
+        (SpincoreBench, digital_cases),
+        # The Pulse Streamer also has 2 analog outputs after its digital channels.
+        (SwabianBench, functools.partial(digital_cases, analog_channel_number=2)),
+        (NI6738Bench, analog_cases),
+    ]
+    for bench_type, cases in benches:
+        bench = bench_type()
+        try:
+            for case, factory in cases(bench.channel_number).items():
+                result = run_case(bench, case, factory, repeat)
+                print(result)
+                results.append(result)
+        finally:
+            bench.close()
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Number of times each case is run."
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="Maximum time in ms allowed to program a single shot.",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Write the results to a JSON file."
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeat)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump([attrs.asdict(result) for result in results], file, indent=2)
+
+    failed = False
+    for result in results:
+        if result.error:
+            print(f"Failed: {result.device} {result.case}", file=sys.stderr)
+            failed = True
+        elif args.budget is not None and result.wall_time * 1e3 > args.budget:
+            print(f"Over budget: {result.device} {result.case}", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
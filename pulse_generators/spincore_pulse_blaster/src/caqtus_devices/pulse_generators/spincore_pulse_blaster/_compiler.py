@@ -1,8 +1,25 @@
+import logging
+from collections.abc import Mapping
+from typing import Any
+
 from caqtus.device import DeviceName
 from caqtus.device.sequencer import SequencerCompiler
-from caqtus.shot_compilation import SequenceContext
+from caqtus.device.sequencer.trigger import ExternalTriggerStart
+from caqtus.shot_compilation import SequenceContext, ShotContext
+from caqtus.shot_compilation.timed_instructions import TimedInstruction
+from caqtus.types.recoverable_exceptions import InvalidValueError
 
 from .configuration import SpincoreSequencerConfiguration
+from .runtime import (
+    SpincorePulseBlaster,
+    SpincoreProgram,
+    lower_sequence,
+    estimate_program_size,
+    INSTRUCTION_MEMORY_SIZE,
+)
+from .runtime.lowering import MAX_LOOP_NESTING
+
+logger = logging.getLogger(__name__)
 
 
 class SpincoreSequencerCompiler(SequencerCompiler):
@@ -22,4 +39,69 @@ class SpincoreSequencerCompiler(SequencerCompiler):
             **super().compile_initialization_parameters(),
             "name": self.device_name,
             "board_number": self.configuration.board_number,
+            "simulate": self.configuration.simulate,
+            "differential_programming": self.configuration.differential_programming,
+            "memory_size": self.configuration.memory_size,
         }
+
+    def compile_shot_parameters(self, shot_context: ShotContext) -> Mapping[str, Any]:
+        parameters = super().compile_shot_parameters(shot_context)
+
+        # The sequence is lowered to board instructions here, so that the device
+        # server only has to stream the resulting table to the board.
+        program = lower_within_budget(
+            parameters["sequence"],
+            device_name=self.device_name,
+            time_step=int(self.configuration.time_step),
+            wait_for_trigger=isinstance(
+                self.configuration.trigger, ExternalTriggerStart
+            ),
+            memory_size=self.configuration.memory_size,
+        )
+        return {**parameters, "sequence": program}
+
+
+def lower_within_budget(
+    sequence: TimedInstruction,
+    device_name: DeviceName,
+    time_step: int,
+    wait_for_trigger: bool,
+    memory_size: int = INSTRUCTION_MEMORY_SIZE,
+) -> SpincoreProgram:
+    """Lower a sequence, checking that it fits in the memory of the board.
+
+    The loop nesting is estimated from the instruction tree, so that sequences
+    nested too deeply are rejected before being lowered.
+
+    Args:
+        sequence: The sequence to lower.
+        device_name: The name of the device, used in error messages.
+        time_step: The duration of a step of the sequence, in ns.
+        wait_for_trigger: If True, the program waits for a hardware trigger.
+        memory_size: The number of instructions that the board can hold.
+
+    Raises:
+        InvalidValueError: If the program would nest loops deeper than the board
+            allows, or if it needs more instructions than the board can hold.
+    """
+
+    size = estimate_program_size(sequence)
+    if size.loop_nesting > MAX_LOOP_NESTING:
+        raise InvalidValueError(
+            f"The sequence for {device_name} nests {size.loop_nesting} loops, but "
+            f"the board only supports {MAX_LOOP_NESTING}"
+        )
+
+    program = lower_sequence(
+        sequence,
+        time_step=time_step,
+        clock_cycle=SpincorePulseBlaster.clock_cycle,
+        channel_number=SpincorePulseBlaster.channel_number,
+        wait_for_trigger=wait_for_trigger,
+    )
+    if len(program) > memory_size:
+        raise InvalidValueError(
+            f"The sequence for {device_name} needs {len(program)} instructions "
+            f"once compressed, but the board can only hold {memory_size}"
+        )
+    return program
@@ -16,7 +16,7 @@ from caqtus.device.sequencer.channel_commands import Constant
 from caqtus.device.sequencer.timing import to_time_step
 from caqtus.device.sequencer.trigger import SoftwareTrigger
 from caqtus.types.expression import Expression
-from ..runtime import SpincorePulseBlaster
+from ..runtime import SpincorePulseBlaster, INSTRUCTION_MEMORY_SIZE
 
 
 @attrs.define
@@ -28,6 +28,15 @@ class SpincoreSequencerConfiguration(SequencerConfiguration[SpincorePulseBlaster
             this number is usually 0.
         time_step: The quantization time step used. All times during a run are multiples
             of this value.
+        simulate: If True, the board is simulated in memory instead of being
+            accessed through the spinapi library.
+        differential_programming: If True, the board memory is only rewritten up
+            to the last instruction that changed since the previous shot.
+            This is not verified on hardware yet, so it is off by default and can't
+            be set from the editor.
+        memory_size: The number of instructions that the memory of the board can
+            hold.
+            Depending on the model, boards have 4k or 32k words of memory.
     """
 
     @classmethod
@@ -52,6 +61,22 @@ class SpincoreSequencerConfiguration(SequencerConfiguration[SpincorePulseBlaster
         converter=decimal.Decimal,
         on_setattr=attrs.setters.pipe(attrs.setters.convert, attrs.setters.validate),
     )
+    simulate: bool = attrs.field(
+        default=False,
+        converter=bool,
+        on_setattr=attrs.setters.convert,
+    )
+    differential_programming: bool = attrs.field(
+        default=False,
+        converter=bool,
+        on_setattr=attrs.setters.convert,
+    )
+    memory_size: int = attrs.field(
+        default=INSTRUCTION_MEMORY_SIZE,
+        converter=int,
+        validator=attrs.validators.ge(1),
+        on_setattr=attrs.setters.pipe(attrs.setters.convert, attrs.setters.validate),
+    )
 
     clock_cycle: ClassVar[int] = 10
 
@@ -1,7 +1,7 @@
 import decimal
 from typing import Optional
 
-from PySide6.QtWidgets import QSpinBox, QWidget
+from PySide6.QtWidgets import QCheckBox, QSpinBox, QWidget
 
 from caqtus.gui.condetrol.device_configuration_editors.sequencer_configuration_editor import (
     SequencerConfigurationEditor,
@@ -29,7 +29,12 @@ class SpincorePulseBlasterDeviceConfigEditor(
         self._board_number.setValue(self.device_configuration.board_number)
         self.form.insertRow(1, "Board number", self._board_number)
 
+        self._simulate = QCheckBox()
+        self._simulate.setChecked(self.device_configuration.simulate)
+        self.form.insertRow(2, "Simulate", self._simulate)
+
     def get_configuration(self) -> SpincoreSequencerConfiguration:
         config = super().get_configuration()
         config.board_number = self._board_number.value()
+        config.simulate = self._simulate.isChecked()
         return config
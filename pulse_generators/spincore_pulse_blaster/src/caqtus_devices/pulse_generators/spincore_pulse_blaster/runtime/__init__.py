@@ -1,3 +1,18 @@
-from .runtime import SpincorePulseBlaster
+from .lowering import (
+    SpincoreProgram,
+    lower_sequence,
+    ProgramSize,
+    estimate_program_size,
+    INSTRUCTION_MEMORY_SIZE,
+)
+from .runtime import SpincorePulseBlaster, run_together
 
-__all__ = ["SpincorePulseBlaster"]
+__all__ = [
+    "SpincorePulseBlaster",
+    "run_together",
+    "SpincoreProgram",
+    "lower_sequence",
+    "ProgramSize",
+    "estimate_program_size",
+    "INSTRUCTION_MEMORY_SIZE",
+]
@@ -0,0 +1,154 @@
+"""Serialized access to several PulseBlaster boards in the same process.
+
+The spinapi library keeps a single global selected board, and every call applies
+to that board.
+The `SpincoreBoardManager` makes sure that the board selection and the calls that
+follow it are not interleaved between threads, and only calls `pb_select_board`
+when the board to use is not already selected.
+"""
+
+import contextlib
+import logging
+import threading
+from collections.abc import Iterator, Sequence
+from types import ModuleType
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BoardSelectionError(RuntimeError):
+    """Raised when the spinapi library can't select a board.
+
+    Attributes:
+        board_number: The number of the board that couldn't be selected.
+        library_error: The error reported by the library.
+    """
+
+    def __init__(self, board_number: int, library_error: str):
+        super().__init__(f"Can't select board {board_number}: {library_error}")
+        self.board_number = board_number
+        self.library_error = library_error
+
+
+class SpincoreBoardManager:
+    """Serializes the access to the boards of a spinapi module.
+
+    There is a single manager per spinapi module, obtained with
+    `get_board_manager`.
+
+    Attributes:
+        selection_count: The number of times `pb_select_board` was called.
+    """
+
+    def __init__(self, spinapi: ModuleType):
+        self._spinapi = spinapi
+        self._lock = threading.RLock()
+        self._selected_board: Optional[int] = None
+        self.selection_count = 0
+
+    @contextlib.contextmanager
+    def select(self, board_number: int) -> Iterator[ModuleType]:
+        """Give exclusive access to the spinapi library with a board selected.
+
+        Other threads can't use the library until the context manager exits.
+
+        Yields:
+            The spinapi module, with the board selected.
+
+        Raises:
+            BoardSelectionError: If the board can't be selected.
+        """
+
+        with self._lock:
+            if self._selected_board != board_number:
+                if self._spinapi.pb_select_board(board_number) != 0:
+                    self._selected_board = None
+                    raise BoardSelectionError(
+                        board_number, self._spinapi.pb_get_error()
+                    )
+                self._selected_board = board_number
+                self.selection_count += 1
+            yield self._spinapi
+
+    def invalidate_selection(self) -> None:
+        """Forget which board is selected, so that the next access selects it."""
+
+        with self._lock:
+            self._selected_board = None
+
+    @contextlib.contextmanager
+    def library(self) -> Iterator[ModuleType]:
+        """Give exclusive access to the spinapi library, without selecting a board.
+
+        This is meant for the calls that don't apply to a specific board.
+        """
+
+        with self._lock:
+            yield self._spinapi
+
+    def start(self, board_numbers: Sequence[int]) -> None:
+        """Reset and start several boards back to back.
+
+        All the boards are reset before any of them is started, so that only the
+        `pb_start` calls separate the start of the first and the last board.
+        The library is held for the whole operation, so that no other call delays
+        the start of the boards that come after.
+        """
+
+        with self._lock:
+            # The board currently selected is reset first to save one selection,
+            # and the boards are started in the reverse order, so that the last
+            # board reset is started without selecting it again.
+            ordered = sorted(
+                board_numbers, key=lambda board: board != self._selected_board
+            )
+            for board_number in ordered:
+                with self.select(board_number) as spinapi:
+                    if spinapi.pb_reset() != 0:
+                        raise RuntimeError(
+                            f"Can't reset board {board_number}. "
+                            f"{spinapi.pb_get_error()}"
+                        )
+            for board_number in reversed(ordered):
+                with self.select(board_number) as spinapi:
+                    if spinapi.pb_start() != 0:
+                        raise RuntimeError(
+                            f"Can't start board {board_number}. "
+                            f"{spinapi.pb_get_error()}"
+                        )
+
+    def stop(self, board_numbers: Sequence[int]) -> None:
+        """Stop several boards.
+
+        All the boards are stopped, even if stopping one of them fails.
+
+        Raises:
+            RuntimeError: If one of the boards could not be stopped.
+        """
+
+        errors = []
+        with self._lock:
+            for board_number in board_numbers:
+                try:
+                    with self.select(board_number) as spinapi:
+                        if spinapi.pb_stop() != 0:
+                            raise RuntimeError(spinapi.pb_get_error())
+                except RuntimeError as error:
+                    errors.append(f"board {board_number}: {error}")
+        if errors:
+            raise RuntimeError(f"Error when stopping the sequence. {'; '.join(errors)}")
+
+
+_managers: dict[str, SpincoreBoardManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_board_manager(spinapi: ModuleType) -> SpincoreBoardManager:
+    """Return the manager shared by all the users of a spinapi module."""
+
+    with _managers_lock:
+        if (manager := _managers.get(spinapi.__name__)) is None:
+            manager = SpincoreBoardManager(spinapi)
+            _managers[spinapi.__name__] = manager
+        return manager
@@ -0,0 +1,646 @@
+"""Hardware independent lowering of timed instructions for the PulseBlaster.
+
+The functions in this module turn a `TimedInstruction` into a table of board
+instructions without calling the spinapi library.
+This allows to compute the program on a machine without the board, and to only
+stream the resulting table to the device.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import logging
+from collections import Counter
+from enum import IntEnum
+from functools import singledispatchmethod
+from typing import Optional
+
+import attrs
+import numpy as np
+
+from caqtus.shot_compilation.timed_instructions import (
+    TimedInstruction,
+    Pattern,
+    Repeated,
+    Concatenated,
+)
+
+logger = logging.getLogger(__name__)
+
+MAX_LOOP_REPETITIONS = 2**20 - 1
+MAX_LOOP_NESTING = 8
+MAX_SUBROUTINE_NESTING = 8
+
+# Number of instructions that the memory of a PulseBlaster board can hold.
+INSTRUCTION_MEMORY_SIZE = 4096
+
+# Longest period, in number of runs, that is looked for when detecting periodic
+# content in patterns.
+MAX_LOOP_PERIOD = 64
+
+
+class Opcode(IntEnum):
+    """Opcodes of the PulseBlaster instructions.
+
+    The values match the ones of `spinapi.Inst`.
+    """
+
+    CONTINUE = 0
+    STOP = 1
+    LOOP = 2
+    END_LOOP = 3
+    JSR = 4
+    RTS = 5
+    BRANCH = 6
+    LONG_DELAY = 7
+    WAIT = 8
+
+
+INSTRUCTION_DTYPE = np.dtype(
+    [
+        ("flags", np.uint32),
+        ("opcode", np.uint8),
+        ("data", np.uint32),
+        # Duration of the instruction in ns.
+        ("duration", np.uint64),
+    ]
+)
+
+
+@attrs.frozen(eq=False)
+class SpincoreProgram:
+    """A program ready to be written to the PulseBlaster.
+
+    Attributes:
+        instructions: The board instructions, with dtype `INSTRUCTION_DTYPE`.
+            The instruction at index i is written at address i on the board.
+        number_ticks: The duration of the program, in time steps.
+            This doesn't include the time spent waiting for a trigger.
+        wait_for_trigger: If True, the program waits for a hardware trigger before
+            outputting the sequence.
+    """
+
+    instructions: np.ndarray = attrs.field()
+    number_ticks: int = attrs.field(converter=int)
+    wait_for_trigger: bool = attrs.field(default=False, converter=bool)
+
+    @instructions.validator  # type: ignore
+    def _validate_instructions(self, _, value):
+        if not isinstance(value, np.ndarray) or value.dtype != INSTRUCTION_DTYPE:
+            raise TypeError(f"Expected an array with dtype {INSTRUCTION_DTYPE}")
+
+    def __len__(self) -> int:
+        return len(self.instructions)
+
+    def digest(self) -> bytes:
+        """Return a hash of the instructions of the program.
+
+        Two programs with the same digest are identical once written on the board.
+        """
+
+        return hashlib.blake2b(
+            np.ascontiguousarray(self.instructions).tobytes(), digest_size=16
+        ).digest()
+
+
+def lower_sequence(
+    sequence: TimedInstruction,
+    time_step: int,
+    clock_cycle: int,
+    channel_number: int,
+    wait_for_trigger: bool = False,
+) -> SpincoreProgram:
+    """Compute the board instructions to output a sequence.
+
+    Args:
+        sequence: The sequence to lower.
+            It must have one boolean field "ch i" for each channel.
+        time_step: The duration of a step of the sequence, in ns.
+            It must be a multiple of the clock cycle.
+        clock_cycle: The duration of a clock cycle of the board, in ns.
+        channel_number: The number of channels of the board.
+        wait_for_trigger: If True, the program holds the first values of the
+            sequence and waits for a hardware trigger before outputting the rest of
+            the sequence.
+
+    Returns:
+        The program to write on the board.
+        It ends with a STOP instruction that holds the last value of the sequence.
+    """
+
+    lowering = _Lowering(
+        time_step=time_step, clock_cycle=clock_cycle, channel_number=channel_number
+    )
+    if wait_for_trigger:
+        # WAIT can't be the first instruction of a program, so the first values are
+        # output by a continue instruction while the board is armed.
+        # The WAIT instruction then outputs the first step of the sequence once
+        # triggered.
+        first_flags = lowering.step_to_flags(sequence[0])
+        lowering.append(_record(first_flags, Opcode.CONTINUE, 0, time_step))
+        lowering.append(_record(first_flags, Opcode.WAIT, 0, time_step))
+        if len(sequence) > 1:
+            lowering.lower(sequence[1:])
+    else:
+        lowering.lower(sequence)
+    lowering.append(
+        _record(lowering.step_to_flags(sequence[-1]), Opcode.STOP, 0, time_step)
+    )
+    instructions = lowering.link()
+    logger.debug(
+        f"Lowered sequence of {len(sequence)} steps into {len(instructions)} "
+        f"instructions"
+    )
+    return SpincoreProgram(
+        instructions=instructions,
+        number_ticks=len(sequence),
+        wait_for_trigger=wait_for_trigger,
+    )
+
+
+def pack_flags(values: np.ndarray | np.void, channel_number: int) -> np.ndarray:
+    """Pack the channel fields of a structured array into 32-bit flag words.
+
+    Bit i of each word is set if the field "ch i" is high at that step.
+
+    Args:
+        values: A structured array with one boolean field per channel, like
+            `Pattern.array`, or a single element of such an array.
+        channel_number: The number of channels to pack.
+
+    Returns:
+        An array of dtype uint32 with the same shape as `values`.
+    """
+
+    values = np.asarray(values)
+    bits = np.stack(
+        [values[f"ch {channel}"] for channel in range(channel_number)], axis=-1
+    ).astype(np.uint32)
+    shifts = np.arange(channel_number, dtype=np.uint32)
+    return np.bitwise_or.reduce(bits << shifts, axis=-1)
+
+
+def run_length_encode(flags: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Merge consecutive identical flag words.
+
+    Returns:
+        The flag word of each run and the number of consecutive steps in each run.
+    """
+
+    if len(flags) == 0:
+        return flags, np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(flags)) + 1))
+    lengths = np.diff(np.append(starts, len(flags)))
+    return flags[starts], lengths
+
+
+def find_periodic_runs(
+    flags: np.ndarray, lengths: np.ndarray, max_period: int, max_run_length: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Find the best loop starting at each run of a run-length encoded pattern.
+
+    For each lag between 2 and `max_period`, the runs are compared with the runs
+    shifted by that lag.
+    The number of consecutive matches starting at a run gives the number of times
+    the block of runs starting there repeats.
+    The lag that saves the most instructions is kept for each run.
+
+    Args:
+        flags: The flag word of each run.
+        lengths: The number of steps of each run.
+        max_period: The longest loop body to look for, in number of runs.
+        max_run_length: Runs longer than this are never put inside a loop, since
+            they can't be held by a single instruction.
+
+    Returns:
+        The period and the number of repetitions of the best loop starting at each
+        run.
+        The period is 0 for runs where no loop saves any instruction.
+    """
+
+    number_runs = len(flags)
+    best_periods = np.zeros(number_runs, dtype=np.int64)
+    best_repetitions = np.ones(number_runs, dtype=np.int64)
+    best_saved = np.zeros(number_runs, dtype=np.int64)
+    can_loop = lengths <= max_run_length
+    for period in range(2, min(max_period, number_runs // 2) + 1):
+        matches = np.zeros(number_runs, dtype=np.bool_)
+        matches[:-period] = (
+            (flags[:-period] == flags[period:])
+            & (lengths[:-period] == lengths[period:])
+            & can_loop[:-period]
+        )
+        repetitions = np.minimum(
+            (_streak_lengths(matches) + period) // period, MAX_LOOP_REPETITIONS
+        )
+        saved = (repetitions - 1) * period
+        better = saved > best_saved
+        best_periods[better] = period
+        best_repetitions[better] = repetitions[better]
+        best_saved[better] = saved[better]
+    return best_periods, best_repetitions
+
+
+def _streak_lengths(mask: np.ndarray) -> np.ndarray:
+    """Return the number of consecutive True values starting at each position."""
+
+    breaks = np.append(np.flatnonzero(~mask), len(mask))
+    positions = np.arange(len(mask))
+    return breaks[np.searchsorted(breaks, positions)] - positions
+
+
+def instruction_digest(instruction: TimedInstruction) -> bytes:
+    """Compute a hash of the content of an instruction tree.
+
+    Two trees with the same digest output the same values.
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+    _update_digest(instruction, digest)
+    return digest.digest()
+
+
+@functools.singledispatch
+def _update_digest(instruction: TimedInstruction, digest) -> None:
+    _update_digest(instruction.to_pattern(), digest)
+
+
+@_update_digest.register
+def _(pattern: Pattern, digest) -> None:
+    array = np.ascontiguousarray(pattern.array)
+    digest.update(f"pattern {array.dtype.descr} {len(array)}".encode())
+    digest.update(array.tobytes())
+
+
+@_update_digest.register
+def _(concatenated: Concatenated, digest) -> None:
+    digest.update(f"concatenated {len(concatenated.instructions)}".encode())
+    for instruction in concatenated.instructions:
+        _update_digest(instruction, digest)
+
+
+@_update_digest.register
+def _(repeated: Repeated, digest) -> None:
+    digest.update(f"repeated {repeated.repetitions}".encode())
+    _update_digest(repeated.instruction, digest)
+
+
+@attrs.frozen
+class ProgramSize:
+    """Estimated resources needed to program a sequence on the board.
+
+    Attributes:
+        instructions: The number of instructions needed before the content of the
+            patterns is compressed.
+            Lowering usually emits much less when the patterns contain long runs
+            or periodic content, but it can emit more when loops cut through
+            nested repetitions, so this is not a bound.
+        loop_nesting: The deepest nesting of loops in the program.
+    """
+
+    instructions: int
+    loop_nesting: int
+
+
+def estimate_program_size(sequence: TimedInstruction) -> ProgramSize:
+    """Estimate the size of the program lowered from a sequence.
+
+    This only walks the instruction tree and never looks at the values of the
+    patterns, so its cost depends on the number of nodes in the tree and not on
+    the number of steps in the sequence.
+    """
+
+    size = _estimate_size(sequence)
+    # The program always ends with a STOP instruction, and can start with two
+    # instructions to wait for a trigger.
+    return ProgramSize(size.instructions + 3, size.loop_nesting)
+
+
+@functools.singledispatch
+def _estimate_size(instruction: TimedInstruction) -> ProgramSize:
+    return ProgramSize(len(instruction), 0)
+
+
+@_estimate_size.register
+def _(concatenated: Concatenated) -> ProgramSize:
+    sizes = [_estimate_size(instruction) for instruction in concatenated.instructions]
+    return ProgramSize(
+        sum(size.instructions for size in sizes),
+        max(size.loop_nesting for size in sizes),
+    )
+
+
+@_estimate_size.register
+def _(repeated: Repeated) -> ProgramSize:
+    if len(repeated.instruction) == 1:
+        # Lowered into a long delay and a continue instruction.
+        return ProgramSize(2, 0)
+    # The LOOP and END_LOOP instructions hold the first and last steps of the
+    # body, so the body is a slight overestimate of what is inside the loop.
+    body = _estimate_size(repeated.instruction)
+    return ProgramSize(body.instructions + 2, body.loop_nesting + 1)
+
+
+def _relocate(records: np.ndarray, offset: int) -> np.ndarray:
+    """Shift the loop addresses of instructions moved by `offset` addresses."""
+
+    relocated = records.copy()
+    end_loops = relocated["opcode"] == Opcode.END_LOOP
+    addresses = relocated["data"][end_loops].astype(np.int64)
+    relocated["data"][end_loops] = addresses + offset
+    return relocated
+
+
+def _record(flags: int, opcode: Opcode, data: int, duration: int) -> np.ndarray:
+    return np.array([(flags, opcode, data, duration)], dtype=INSTRUCTION_DTYPE)
+
+
+class _Block:
+    def __init__(self, records: np.ndarray):
+        self.records = records
+        self.subroutine: Optional[int] = None
+
+
+class _Lowering:
+    def __init__(self, time_step: int, clock_cycle: int, channel_number: int):
+        if time_step % clock_cycle != 0:
+            raise ValueError(
+                f"Time step ({time_step}) must be a multiple of the clock cycle "
+                f"({clock_cycle})."
+            )
+        self.time_step = time_step
+        self.channel_number = channel_number
+        cycles_per_step = time_step // clock_cycle
+        self.max_number_ticks = (2**32 - 1) // cycles_per_step
+        self._chunks: list[np.ndarray] = []
+        self._address = 0
+        self._loop_depth = 0
+        self._call_depth = 0
+
+        # Instructions of each block lowered on its own, indexed by the content of
+        # the block and the loop depth at which it was lowered.
+        self._blocks: dict[tuple[bytes, int], _Block] = {}
+        # Bodies of the subroutines, in the order in which they are placed after
+        # the main program.
+        # The data of JSR instructions is the index of the subroutine in this list
+        # until the program is linked.
+        self._subroutines: list[np.ndarray] = []
+
+    @property
+    def address(self) -> int:
+        """The address at which the next instruction will be placed."""
+
+        return self._address
+
+    def append(self, records: np.ndarray) -> None:
+        self._chunks.append(records)
+        self._address += len(records)
+
+    def build(self) -> np.ndarray:
+        if not self._chunks:
+            return np.zeros(0, dtype=INSTRUCTION_DTYPE)
+        return np.concatenate(self._chunks)
+
+    def link(self) -> np.ndarray:
+        """Place the subroutines after the main program and resolve their calls."""
+
+        main = self.build()
+        base_addresses = []
+        tables = [main]
+        address = len(main)
+        for subroutine in self._subroutines:
+            base_addresses.append(address)
+            tables.append(_relocate(subroutine, address))
+            address += len(subroutine)
+        program = np.concatenate(tables)
+        calls = program["opcode"] == Opcode.JSR
+        if np.any(calls):
+            program["data"][calls] = np.array(base_addresses)[program["data"][calls]]
+        return program
+
+    def _lower_detached(self, instruction: TimedInstruction) -> np.ndarray:
+        """Lower an instruction as if it was placed at address 0."""
+
+        chunks, address = self._chunks, self._address
+        self._chunks, self._address = [], 0
+        try:
+            self.lower(instruction)
+            return self.build()
+        finally:
+            self._chunks, self._address = chunks, address
+
+    def step_to_flags(self, values: np.void) -> int:
+        return int(pack_flags(values, self.channel_number))
+
+    @singledispatchmethod
+    def lower(self, instruction: TimedInstruction) -> None:
+        raise NotImplementedError(
+            f"Can't program instruction with type {type(instruction)}"
+        )
+
+    @lower.register
+    def _(self, pattern: Pattern) -> None:
+        flags = pack_flags(pattern.array, self.channel_number)
+        run_flags, run_lengths = run_length_encode(flags)
+        start = self.address
+        if self._loop_depth < MAX_LOOP_NESTING:
+            self._lower_runs_with_loops(run_flags, run_lengths)
+        else:
+            self.append(self.continue_records(run_flags, run_lengths))
+        number_instructions = self.address - start
+        if number_instructions > 0:
+            logger.debug(
+                f"Compressed pattern of {len(flags)} steps into "
+                f"{number_instructions} instructions "
+                f"(ratio {len(flags) / number_instructions:.1f})"
+            )
+
+    def _lower_runs_with_loops(
+        self, run_flags: np.ndarray, run_lengths: np.ndarray
+    ) -> None:
+        periods, repetitions = find_periodic_runs(
+            run_flags, run_lengths, MAX_LOOP_PERIOD, self.max_number_ticks
+        )
+        loop_starts = np.flatnonzero(periods)
+        position = 0
+        number_runs = len(run_flags)
+        while position < number_runs:
+            index = np.searchsorted(loop_starts, position)
+            next_loop = (
+                int(loop_starts[index]) if index < len(loop_starts) else number_runs
+            )
+            if next_loop > position:
+                self.append(
+                    self.continue_records(
+                        run_flags[position:next_loop], run_lengths[position:next_loop]
+                    )
+                )
+                position = next_loop
+                continue
+            period = int(periods[position])
+            repetition = int(repetitions[position])
+            self.append_loop(
+                run_flags[position : position + period],
+                run_lengths[position : position + period],
+                repetition,
+            )
+            position += period * repetition
+
+    def append_loop(
+        self, flags: np.ndarray, lengths: np.ndarray, repetitions: int
+    ) -> None:
+        """Add a loop that repeats a block of runs.
+
+        The first run of the block is held by the LOOP instruction and the last
+        one by the END_LOOP instruction, so the block must contain at least two
+        runs, each short enough to fit in a single instruction.
+        """
+
+        records = np.zeros(len(flags), dtype=INSTRUCTION_DTYPE)
+        records["flags"] = flags
+        records["opcode"] = Opcode.CONTINUE
+        records["duration"] = lengths * self.time_step
+        records["opcode"][0] = Opcode.LOOP
+        records["data"][0] = repetitions
+        records["opcode"][-1] = Opcode.END_LOOP
+        records["data"][-1] = self.address
+        self.append(records)
+
+    @lower.register
+    def _(self, concatenate: Concatenated) -> None:
+        instructions = concatenate.instructions
+        if self._call_depth >= MAX_SUBROUTINE_NESTING:
+            for instruction in instructions:
+                self.lower(instruction)
+            return
+
+        # Only blocks with the same length can be identical, so we avoid hashing the
+        # content of blocks that appear only once.
+        length_counts = Counter(len(instruction) for instruction in instructions)
+        digests = [
+            (
+                instruction_digest(instruction)
+                if len(instruction) >= 3 and length_counts[len(instruction)] > 1
+                else None
+            )
+            for instruction in instructions
+        ]
+        digest_counts = Counter(digests)
+        for instruction, digest in zip(instructions, digests, strict=True):
+            if digest is not None and digest_counts[digest] > 1:
+                self._lower_shared_block(instruction, digest)
+            else:
+                self.lower(instruction)
+
+    def _lower_shared_block(
+        self, instruction: TimedInstruction, digest: bytes
+    ) -> None:
+        """Lower a block that appears several times in the sequence.
+
+        The block is lowered only once.
+        If possible, it is placed in a subroutine and each occurrence is replaced by
+        a call to it, otherwise its instructions are copied at each occurrence.
+        """
+
+        key = (digest, self._loop_depth)
+        if (block := self._blocks.get(key)) is None:
+            self._call_depth += 1
+            try:
+                block = _Block(self._lower_detached(instruction))
+            finally:
+                self._call_depth -= 1
+            # The JSR instruction holds the first values of the block and the RTS
+            # instruction holds the last ones, so both must be plain continue
+            # instructions.
+            # The subroutine only saves instructions if it has at least one
+            # instruction between the call and the return.
+            records = block.records
+            if (
+                len(records) >= 3
+                and records[0]["opcode"] == Opcode.CONTINUE
+                and records[-1]["opcode"] == Opcode.CONTINUE
+            ):
+                body = _relocate(records[1:], -1)
+                body["opcode"][-1] = Opcode.RTS
+                block.subroutine = len(self._subroutines)
+                self._subroutines.append(body)
+            self._blocks[key] = block
+        if block.subroutine is None:
+            self.append(_relocate(block.records, self.address))
+        else:
+            call = block.records[:1].copy()
+            call["opcode"] = Opcode.JSR
+            call["data"] = block.subroutine
+            self.append(call)
+
+    @lower.register
+    def _(self, repeat: Repeated) -> None:
+        if len(repeat.instruction) == 1:
+            flags = self.step_to_flags(repeat.instruction[0])
+            self.append(
+                self.continue_records(
+                    np.array([flags], dtype=np.uint32),
+                    np.array([repeat.repetitions], dtype=np.int64),
+                )
+            )
+            return
+        repetitions = repeat.repetitions
+        if repetitions > MAX_LOOP_REPETITIONS:
+            raise ValueError(
+                f"Can't program a for loop with more than {MAX_LOOP_REPETITIONS} "
+                f"repetitions."
+            )
+        loop_beginning = self.address
+        self.append(
+            _record(
+                self.step_to_flags(repeat.instruction[0]),
+                Opcode.LOOP,
+                repetitions,
+                self.time_step,
+            )
+        )
+        middle = repeat.instruction[1:-1]
+        if len(middle) > 0:
+            self._loop_depth += 1
+            try:
+                self.lower(middle)
+            finally:
+                self._loop_depth -= 1
+        self.append(
+            _record(
+                self.step_to_flags(repeat.instruction[-1]),
+                Opcode.END_LOOP,
+                loop_beginning,
+                self.time_step,
+            )
+        )
+
+    def continue_records(self, flags: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        """Compute the instructions to hold each flag word for the given duration.
+
+        Durations longer than what a single instruction can hold are split into a
+        long delay followed by a shorter continue instruction.
+        """
+
+        long_repetitions, remainders = np.divmod(lengths, self.max_number_ticks)
+        has_long = long_repetitions > 0
+        # A run that is an exact multiple of the long delay needs no continue.
+        has_short = remainders > 0
+        counts = has_long.astype(np.int64) + has_short
+        starts = np.cumsum(counts) - counts
+        records = np.zeros(int(counts.sum()), dtype=INSTRUCTION_DTYPE)
+
+        long_indices = starts[has_long]
+        records["flags"][long_indices] = flags[has_long]
+        records["opcode"][long_indices] = Opcode.LONG_DELAY
+        # The delay multiplier must be at least 2, so we use delays of half the
+        # maximum duration and twice as many repetitions.
+        records["data"][long_indices] = 2 * long_repetitions[has_long]
+        records["duration"][long_indices] = self.max_number_ticks * self.time_step // 2
+
+        short_indices = (starts + has_long)[has_short]
+        records["flags"][short_indices] = flags[has_short]
+        records["opcode"][short_indices] = Opcode.CONTINUE
+        records["duration"][short_indices] = remainders[has_short] * self.time_step
+        return records
@@ -1,12 +1,14 @@
+import asyncio
 import contextlib
 import decimal
 import logging
-from collections.abc import Sequence, Mapping
+import time
+from collections.abc import Callable, Iterator
 from enum import IntFlag
-from functools import singledispatchmethod
-from typing import ClassVar
+from typing import ClassVar, Optional
 
 import attrs.validators
+import numpy as np
 from attrs import define, field
 from attrs.setters import frozen
 from attrs.validators import instance_of
@@ -14,15 +16,26 @@ from attrs.validators import instance_of
 from caqtus.device import RuntimeDevice
 from caqtus.device.sequencer import Sequencer, TimeStep
 from caqtus.device.sequencer.runtime import ProgrammedSequence, SequenceStatus
-from caqtus.device.sequencer.trigger import Trigger, SoftwareTrigger
-from caqtus.shot_compilation.timed_instructions import (
-    TimedInstruction,
-    Pattern,
-    Repeated,
-    Concatenated,
+from caqtus.device.sequencer.trigger import (
+    Trigger,
+    SoftwareTrigger,
+    ExternalTriggerStart,
+    TriggerEdge,
 )
+from caqtus.shot_compilation.timed_instructions import TimedInstruction
 from caqtus.types.recoverable_exceptions import ConnectionFailedError
 from caqtus.utils import log_exception
+from .board_manager import (
+    SpincoreBoardManager,
+    get_board_manager,
+    BoardSelectionError,
+)
+from .lowering import (
+    SpincoreProgram,
+    lower_sequence,
+    Opcode,
+    INSTRUCTION_MEMORY_SIZE,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
@@ -51,7 +64,31 @@ class SpincorePulseBlaster(Sequencer, RuntimeDevice):
             This can be useful to debug the program, but generates large files.
         time_step: The time step of the sequencer in nanoseconds.
         trigger: Indicates how the sequence is started and how it is clocked.
-            Only SoftwareTrigger is supported at the moment.
+            With SoftwareTrigger, the sequence starts when the board is started.
+            With ExternalTriggerStart, the board is armed when the sequence is run
+            and the sequence starts on a falling edge of the HW_Trigger input.
+        simulate: If True, the board is simulated in memory by the
+            `simulated_spinapi` module instead of being accessed through the spinapi
+            library.
+            This allows to run the device without hardware.
+        memory_size: The number of instructions that the memory of the board can
+            hold.
+            When simulating, the simulated board is given this memory size.
+        differential_programming: If True, only the beginning of the board memory
+            up to the last instruction that differs from the previous program is
+            rewritten.
+            This relies on the board keeping the instructions that are not
+            overwritten when a new program is written.
+            Since spinapi always writes from address 0, the time saved depends on
+            where the last change is in the program, and not on the number of
+            changed instructions: a change near the end of the program still
+            rewrites almost all of it.
+            This is off by default and not exposed in the configuration editor,
+            since it wasn't verified on hardware that the board keeps its memory
+            across `pb_start_programming`.
+        program_cache_hits: The number of times program_sequence was called with
+            the sequence already on the board, so that reprogramming was skipped.
+        program_cache_misses: The number of times the board had to be programmed.
     """
 
     channel_number: ClassVar[int] = 24
@@ -62,6 +99,15 @@ class SpincorePulseBlaster(Sequencer, RuntimeDevice):
     spincore_lib_debug: bool = field(
         default=False, validator=instance_of(bool), on_setattr=frozen
     )
+    simulate: bool = field(
+        default=False, validator=instance_of(bool), on_setattr=frozen
+    )
+    differential_programming: bool = field(
+        default=False, validator=instance_of(bool), on_setattr=frozen
+    )
+    memory_size: int = field(
+        default=INSTRUCTION_MEMORY_SIZE, validator=instance_of(int), on_setattr=frozen
+    )
 
     trigger: Trigger = field(
         factory=SoftwareTrigger,
@@ -69,6 +115,16 @@ class SpincorePulseBlaster(Sequencer, RuntimeDevice):
         on_setattr=frozen,
     )
 
+    program_cache_hits: int = field(default=0, init=False)
+    program_cache_misses: int = field(default=0, init=False)
+    # Digest of the sequence currently programmed on the board, or None if the
+    # content of the board is unknown.
+    _programmed_digest: Optional[bytes] = field(default=None, init=False)
+    # Content of the instruction memory of the board, or None if unknown.
+    _board_instructions: Optional[np.ndarray] = field(
+        default=None, init=False, eq=False, repr=False
+    )
+
     @time_step.validator  # type: ignore
     def _validate_time_step(self, _, value):
         div, mod = divmod(value, self.clock_cycle)
@@ -85,235 +141,386 @@ class SpincorePulseBlaster(Sequencer, RuntimeDevice):
 
     @trigger.validator  # type: ignore
     def _validate_trigger(self, _, value):
-        if not isinstance(value, SoftwareTrigger):
+        if isinstance(value, ExternalTriggerStart):
+            # The HW_Trigger input of the board is active low.
+            if value.edge != TriggerEdge.FALLING:
+                raise NotImplementedError(
+                    f"Trigger edge {value.edge} is not implemented for the Spincore "
+                    f"PulseBlaster, only falling edges can trigger the board"
+                )
+        elif not isinstance(value, SoftwareTrigger):
             raise NotImplementedError(
                 f"Trigger type {type(value)} is not implemented for the Spincore "
                 f"PulseBlaster"
             )
         return value
 
+    @property
+    def waits_for_trigger(self) -> bool:
+        """Indicates if the sequences wait for a hardware trigger to start."""
+
+        return isinstance(self.trigger, ExternalTriggerStart)
+
     @log_exception(logger)
     def initialize(self) -> None:
         super().initialize()
 
-        from . import spinapi
-
-        self._spinapi = spinapi
+        if self.simulate:
+            from . import simulated_spinapi as spinapi
+        else:
+            from . import spinapi
 
-        self._spinapi.pb_set_debug(self.spincore_lib_debug)
+        # Several boards can be used in the same process, so all the calls to the
+        # library go through the manager that serializes the board selection.
+        self._board_manager = get_board_manager(spinapi)
 
-        board_count = self._spinapi.pb_count_boards()
+        with self._board_manager.library() as library:
+            library.pb_set_debug(self.spincore_lib_debug)
+            board_count = library.pb_count_boards()
         if self.board_number >= board_count:
             raise ConnectionFailedError(
                 f"Can't access board {self.board_number}\nThere are only"
                 f" {board_count} boards"
             )
-        if self._spinapi.pb_select_board(self.board_number) != 0:
-            raise ConnectionFailedError(
-                f"Can't access board {self.board_number}: "
-                f"{self._spinapi.pb_get_error()}"
-            )
 
-        if self._spinapi.pb_init() != 0:
+        self._board_manager.invalidate_selection()
+        self._invalidate_program_cache()
+        try:
+            with self._board_manager.select(self.board_number):
+                pass
+        except BoardSelectionError as error:
             raise ConnectionFailedError(
-                f"Can't initialize board {self.board_number}: "
-                f"{self._spinapi.pb_get_error()}"
+                f"Can't access board {self.board_number}: {error.library_error}"
+            ) from error
+        with self._board_manager.select(self.board_number) as library:
+            if library.pb_init() != 0:
+                raise ConnectionFailedError(
+                    f"Can't initialize board {self.board_number}: "
+                    f"{library.pb_get_error()}"
+                )
+            self._add_closing_callback(self._close_board)
+            self._add_closing_callback(self._invalidate_program_cache)
+
+            library.pb_core_clock(1e3 / self.clock_cycle)
+            if self.simulate:
+                library.set_memory_size(self.memory_size)
+
+    def _close_board(self) -> None:
+        with self._board_manager.select(self.board_number) as library:
+            library.pb_close()
+
+    def program_sequence(
+        self, sequence: TimedInstruction | SpincoreProgram
+    ) -> ProgrammedSequence:
+        """Write a sequence on the board.
+
+        Args:
+            sequence: Either a sequence of instructions, or a program that was
+                already lowered with `lower_sequence`, typically by the compiler.
+        """
+
+        if isinstance(sequence, SpincoreProgram):
+            program = sequence
+            if program.wait_for_trigger != self.waits_for_trigger:
+                raise ValueError(
+                    f"Program was lowered with wait_for_trigger="
+                    f"{program.wait_for_trigger}, but the device trigger is "
+                    f"{self.trigger}"
+                )
+        else:
+            program = self.lower_sequence(sequence)
+        digest = program.digest()
+        if digest == self._programmed_digest:
+            self.program_cache_hits += 1
+            logger.debug("Sequence already programmed, skipping reprogramming")
+        else:
+            self.program_cache_misses += 1
+            previous = self._board_instructions
+            # The board content is unknown until programming succeeds.
+            self._invalidate_program_cache()
+            self._board_instructions = self._write_program(program, previous)
+            self._programmed_digest = digest
+        return _ProgrammedSequence(
+            self._board_manager,
+            self.board_number,
+            duration=program.number_ticks * float(self.time_step) * 1e-9,
+            on_error=self._invalidate_program_cache,
+        )
+
+    def lower_sequence(self, sequence: TimedInstruction) -> SpincoreProgram:
+        """Compute the board instructions for a sequence without accessing the board."""
+
+        return lower_sequence(
+            sequence,
+            time_step=int(self.time_step),
+            clock_cycle=self.clock_cycle,
+            channel_number=self.channel_number,
+            wait_for_trigger=self.waits_for_trigger,
+        )
+
+    def _invalidate_program_cache(self) -> None:
+        self._programmed_digest = None
+        self._board_instructions = None
+
+    @log_exception(logger)
+    def _write_program(
+        self, program: SpincoreProgram, previous: Optional[np.ndarray]
+    ) -> np.ndarray:
+        """Write a program on the board.
+
+        With differential programming, only the unchanged tail of the memory is
+        skipped, so the number of instructions written is the address of the last
+        changed instruction plus one.
+
+        Args:
+            program: The program to write.
+            previous: The instructions in the board memory before writing, if known.
+
+        Returns:
+            The instructions in the board memory after writing.
+        """
+
+        instructions = program.instructions
+        if self.differential_programming and previous is not None:
+            # spinapi always writes from address 0, so the instructions up to the
+            # last one that changed must be rewritten.
+            number_to_write = _number_of_instructions_to_rewrite(
+                instructions, previous
+            )
+            logger.debug(
+                f"Rewriting {number_to_write} of {len(instructions)} instructions"
+            )
+        else:
+            number_to_write = len(instructions)
+        if previous is not None:
+            board_instructions = np.concatenate(
+                [instructions, previous[len(instructions) :]]
             )
-        self._add_closing_callback(self._spinapi.pb_close)
+        else:
+            board_instructions = instructions
+        if number_to_write == 0:
+            return board_instructions
 
-        self._spinapi.pb_core_clock(1e3 / self.clock_cycle)
+        with self._board_manager.select(self.board_number) as spinapi:
+            self._write_instructions(spinapi, instructions[:number_to_write])
+        return board_instructions
 
-    def program_sequence(self, sequence: TimedInstruction) -> ProgrammedSequence:
-        spinapi = self._spinapi
+    @staticmethod
+    def _write_instructions(spinapi, instructions: np.ndarray) -> None:
         if spinapi.pb_start_programming(spinapi.PULSE_PROGRAM) != 0:
             raise RuntimeError(
                 f"Can't start programming sequence.{spinapi.pb_get_error()}"
             )
 
-        self._program_instruction(sequence)
-        self.program_stop(sequence[-1])
+        for expected_address, (flags, opcode, data, duration) in enumerate(
+            zip(
+                instructions["flags"].tolist(),
+                instructions["opcode"].tolist(),
+                instructions["data"].tolist(),
+                instructions["duration"].tolist(),
+            )
+        ):
+            address = spinapi.pb_inst_pbonly(flags, opcode, data, duration * spinapi.ns)
+            if address < 0:
+                raise RuntimeError(
+                    f"An error occurred when programming instruction "
+                    f"{Opcode(opcode).name} with data {data} and duration "
+                    f"{duration} ns. {spinapi.pb_get_error()}"
+                )
+            if address != expected_address:
+                raise RuntimeError(
+                    f"Instruction was written at address {address} instead of "
+                    f"{expected_address}"
+                )
 
         if spinapi.pb_stop_programming() != 0:
             raise RuntimeError(
                 "An error occurred when finishing programming the sequence."
                 f"{spinapi.pb_get_error()}"
             )
-        return _ProgrammedSequence(spinapi)
 
-    @singledispatchmethod
-    def _program_instruction(self, instruction: TimedInstruction) -> int:
-        raise NotImplementedError(
-            f"Can't program instruction with type {type(instruction)}"
-        )
 
-    @_program_instruction.register
-    @log_exception(logger)
-    def _(self, pattern: Pattern):
-        for i in range(len(pattern)):
-            values = pattern[i]
-            outputs = [
-                values[f"ch {channel}"] for channel in range(self.channel_number)
-            ]
-            self._program_continue(outputs, 1)
+def _number_of_instructions_to_rewrite(
+    instructions: np.ndarray, previous: np.ndarray
+) -> int:
+    """Return the length of the memory prefix that must be written.
 
-    @property
-    def max_number_ticks(self) -> int:
-        cycles_per_step = int(self.time_step / self.clock_cycle)
-        return int((2**32 - 1) / cycles_per_step)
+    Args:
+        instructions: The instructions that must be in the board memory.
+        previous: The instructions currently in the board memory.
+    """
 
-    @property
-    def max_duration(self) -> float:
-        return self.max_number_ticks * self._time_step * self._spinapi.ns
+    if len(instructions) > len(previous):
+        return len(instructions)
+    common = len(instructions)
+    differences = np.flatnonzero(instructions != previous[:common])
+    if len(differences) == 0:
+        return 0
+    return int(differences[-1]) + 1
 
-    @property
-    def _time_step(self) -> int:
-        # We know that the time step is a multiple of the clock cycle, so it is an
-        # integer, and we can safely case it.
-        return int(self.time_step)
-
-    def _program_continue(self, output_: Sequence[bool], number_ticks: int):
-        spinapi = self._spinapi
-        # break the duration into multiple long waits and one short wait
-        number_of_repetitions, remainder = divmod(number_ticks, self.max_number_ticks)
-
-        flags = self._output_to_flags(output_)
-        if number_of_repetitions >= 1:
-            # Delay multiplier must be greater than 2, so we divide by 2 the length of
-            # the wait and multiply the number of repetitions by 2
-            if (
-                spinapi.pb_inst_pbonly(
-                    flags,
-                    spinapi.Inst.LONG_DELAY,
-                    2 * number_of_repetitions,
-                    self.max_duration / 2,
-                )
-                < 0
-            ):
-                raise RuntimeError(
-                    "An error occurred when programming a long delay of duration"
-                    f" {self.max_duration / 2} s with"
-                    f" {2*number_of_repetitions} repetitions. "
-                )
-        duration = remainder * self._time_step * spinapi.ns
-        if spinapi.pb_inst_pbonly(flags, spinapi.Inst.CONTINUE, 0, duration) < 0:
-            raise RuntimeError(
-                "An error occurred when programming a continue instruction with"
-                f" duration {duration} s."
-            )
 
-    @_program_instruction.register
-    @log_exception(logger)
-    def _(self, repeat: Repeated):
-        spinapi = self._spinapi
-        if len(repeat.instruction) == 1:
-            channel_values = repeat.instruction.to_pattern()[0]
-            outputs = [
-                channel_values[f"ch {channel}"]
-                for channel in range(self.channel_number)
-            ]
-            self._program_continue(outputs, repeat.repetitions)
-            return
-        else:
-            for_part = repeat.instruction[0]
-            middle = repeat.instruction[1:-1]
-            end_for_part = repeat.instruction[-1]
-            rep = repeat.repetitions
-        for_flag = self._output_to_flags(
-            [for_part[f"ch {channel}"] for channel in range(self.channel_number)]
-        )
-        end_for_flag = self._output_to_flags(
-            [end_for_part[f"ch {channel}"] for channel in range(self.channel_number)]
-        )
-        logger.debug(f"for {rep=}")
-        if rep > 2**20 - 1:
-            raise ValueError(
-                f"Can't program a for loop with more than {2**20 - 1} repetitions."
-            )
-        if (
-            loop_beginning := spinapi.pb_inst_pbonly(
-                for_flag, spinapi.Inst.LOOP, rep, self._time_step * spinapi.ns
-            )
-        ) < 0:
-            raise RuntimeError(
-                "An error occurred when programming the sequence."
-                f"{spinapi.pb_get_error()}"
-            )
-        if len(middle) > 0:
-            self._program_instruction(middle)
-
-        if (
-            spinapi.pb_inst_pbonly(
-                end_for_flag,
-                spinapi.Inst.END_LOOP,
-                loop_beginning,
-                self._time_step * spinapi.ns,
-            )
-            < 0
-        ):
-            raise RuntimeError(
-                "An error occurred when programming the sequence."
-                f"{spinapi.pb_get_error()}"
-            )
+class _ProgrammedSequence(ProgrammedSequence):
+    def __init__(
+        self,
+        board_manager: SpincoreBoardManager,
+        board_number: int,
+        duration: float,
+        on_error: Callable[[], None],
+    ):
+        """
+        Args:
+            board_manager: The manager used to access the board.
+            board_number: The number of the board running the sequence.
+            duration: The expected duration of the sequence, in seconds.
+            on_error: Called when an error occurs while running the sequence.
+        """
+
+        self._board_manager = board_manager
+        self._board_number = board_number
+        self._duration = duration
+        self._on_error = on_error
 
-    @_program_instruction.register
-    @log_exception(logger)
-    def _(self, concatenate: Concatenated):
-        for instruction in concatenate.instructions:
-            self._program_instruction(instruction)
-
-    def program_stop(self, pattern: Mapping[str, bool]):
-        spinapi = self._spinapi
-        outputs = [pattern[f"ch {channel}"] for channel in range(self.channel_number)]
-        flags = self._output_to_flags(outputs)
-        if (
-            spinapi.pb_inst_pbonly(
-                flags, spinapi.Inst.STOP, 0, self._time_step * spinapi.ns
-            )
-            < 0
-        ):
-            raise RuntimeError(
-                "An error occurred when programming the sequence. "
-                f"{spinapi.pb_get_error()}"
-            )
+    @contextlib.contextmanager
+    def run(self):
+        with run_together(self) as (status,):
+            yield status
 
-    def _output_to_flags(self, states: Sequence[bool]) -> int:
-        flags = 0
-        for channel, state in zip(range(self.channel_number), states, strict=True):
-            flags |= int(state) << channel
-        return flags
 
+@contextlib.contextmanager
+def run_together(
+    *sequences: ProgrammedSequence,
+) -> Iterator[tuple[SequenceStatus, ...]]:
+    """Run sequences programmed on several boards, starting them together.
 
-class _ProgrammedSequence(ProgrammedSequence):
-    def __init__(self, spinapi):
-        self._spinapi = spinapi
+    The boards are reset and then started with a single batched call to the board
+    manager, so that the delay between their starts is as short as possible.
 
-    @contextlib.contextmanager
-    def run(self):
-        spinapi = self._spinapi
-        if spinapi.pb_reset() != 0:
-            raise RuntimeError(f"Can't reset the board. {spinapi.pb_get_error()}")
+    Args:
+        sequences: Sequences returned by `SpincorePulseBlaster.program_sequence`,
+            for different boards accessed through the same spinapi library.
+
+    Yields:
+        The status of each sequence, in the same order as the sequences.
+        When the context manager exits, all the sequences must be finished.
+
+    Raises:
+        ValueError: If the sequences can't be started together.
+    """
 
-        if spinapi.pb_start() != 0:
-            raise RuntimeError(f"Can't start the sequence. {spinapi.pb_get_error()}")
-        status = _SequenceStatus(spinapi)
+    if not sequences:
+        raise ValueError("At least one sequence must be given")
+    if not all(isinstance(sequence, _ProgrammedSequence) for sequence in sequences):
+        raise ValueError("Only Spincore sequences can be run together")
+    board_manager = sequences[0]._board_manager
+    if any(sequence._board_manager is not board_manager for sequence in sequences):
+        raise ValueError("Sequences must use the same spinapi library")
+    board_numbers = [sequence._board_number for sequence in sequences]
+    if len(set(board_numbers)) != len(board_numbers):
+        raise ValueError(f"Sequences must run on different boards: {board_numbers}")
+
+    try:
+        board_manager.start(board_numbers)
+        start_time = time.monotonic()
+        statuses = tuple(
+            _SequenceStatus(
+                board_manager,
+                sequence._board_number,
+                start_time + sequence._duration,
+            )
+            for sequence in sequences
+        )
         try:
-            yield status
-            if not status.is_finished():
-                while not status.is_finished():
-                    pass
+            yield statuses
+            unfinished = [status for status in statuses if not status.is_finished()]
+            for status in unfinished:
+                # A board still waiting for its trigger might never be triggered, so
+                # it is stopped right away, while a running board is given the time
+                # it is expected to need to finish.
+                if not status.is_waiting():
+                    status.wait_until_expected_end()
+            if unfinished:
                 raise RuntimeError("Run block exited before the sequence finished")
         finally:
-            if spinapi.pb_stop() != 0:
-                raise RuntimeError(
-                    f"Error when stopping the sequence. {spinapi.pb_get_error()}"
-                )
+            board_manager.stop(board_numbers)
+    except BaseException:
+        for sequence in sequences:
+            sequence._on_error()
+        raise
 
 
 class _SequenceStatus(SequenceStatus):
-    def __init__(self, spinapi):
-        self._spinapi = spinapi
+    def __init__(
+        self,
+        board_manager: SpincoreBoardManager,
+        board_number: int,
+        expected_end: float,
+    ):
+        """
+        Args:
+            board_manager: The manager used to access the board.
+            board_number: The number of the board running the sequence.
+            expected_end: The value of `time.monotonic()` at which the sequence is
+                expected to finish.
+        """
+
+        self._board_manager = board_manager
+        self._board_number = board_number
+        self._expected_end = expected_end
 
     def is_finished(self) -> bool:
-        spinapi = self._spinapi
-        is_running = spinapi.pb_read_status() & SpincoreStatus.Running
-        return not is_running
+        # A board armed on a WAIT instruction is not finished, even if it doesn't
+        # report that it is running.
+        is_active = self._read_status() & (
+            SpincoreStatus.Running | SpincoreStatus.Waiting
+        )
+        return not is_active
+
+    def is_waiting(self) -> bool:
+        """Indicates if the board is armed and waiting for a hardware trigger."""
+
+        return bool(self._read_status() & SpincoreStatus.Waiting)
+
+    def wait_until_expected_end(self) -> None:
+        """Wait for the sequence to finish, but not much after its expected end."""
+
+        deadline = self._expected_end + _END_TOLERANCE
+        delay = _MIN_POLL_INTERVAL
+        while not self.is_finished() and time.monotonic() < deadline:
+            delay = self._next_poll_delay(delay)
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0.0)))
+
+    def _read_status(self) -> int:
+        with self._board_manager.select(self._board_number) as spinapi:
+            return spinapi.pb_read_status()
+
+    def block_until_finished(self) -> None:
+        """Wait for the sequence to finish, without holding the processor."""
+
+        delay = _MIN_POLL_INTERVAL
+        while not self.is_finished():
+            delay = self._next_poll_delay(delay)
+            time.sleep(delay)
+
+    async def wait_finished(self) -> None:
+        """Wait for the sequence to finish, letting other tasks run meanwhile."""
+
+        delay = _MIN_POLL_INTERVAL
+        while not self.is_finished():
+            delay = self._next_poll_delay(delay)
+            await asyncio.sleep(delay)
+
+    def _next_poll_delay(self, previous_delay: float) -> float:
+        # The delay between two reads of the board status grows exponentially, but
+        # we never sleep past the expected end of the sequence.
+        delay = min(2 * previous_delay, _MAX_POLL_INTERVAL)
+        remaining = self._expected_end - time.monotonic()
+        if remaining > 0:
+            delay = min(delay, remaining)
+        return max(delay, _MIN_POLL_INTERVAL)
+
+
+_MIN_POLL_INTERVAL = 100e-6
+_MAX_POLL_INTERVAL = 20e-3
+# How long after its expected end a sequence can still be running when the run
+# block exits early, before the board is stopped.
+_END_TOLERANCE = 10e-3
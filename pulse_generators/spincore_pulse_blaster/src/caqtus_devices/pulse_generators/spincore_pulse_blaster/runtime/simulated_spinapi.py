@@ -0,0 +1,437 @@
+"""Pure python stand-in for the spinapi module.
+
+This module exposes the same functions as `spinapi`, but instead of talking to a
+board through the spinapi library, it simulates PulseBlaster boards in memory.
+It models the size of the instruction memory, the nesting limits of loops and
+subroutines, and the duration of the programmed sequence.
+A board that reaches a WAIT instruction stays in the waiting state until a hardware
+trigger is simulated with `send_trigger`.
+
+It is meant to exercise the runtime without hardware, for tests and benchmarks.
+"""
+
+import logging
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+PULSE_PROGRAM = 0
+FREQ_REGS = 1
+
+
+def enum(**enums):
+    return type("Enum", (), enums)
+
+
+ns = 1.0
+us = 1000.0
+ms = 1000000.0
+
+MHz = 1.0
+kHz = 0.001
+Hz = 0.000001
+
+# Instruction enum
+Inst = enum(
+    CONTINUE=0,
+    STOP=1,
+    LOOP=2,
+    END_LOOP=3,
+    JSR=4,
+    RTS=5,
+    BRANCH=6,
+    LONG_DELAY=7,
+    WAIT=8,
+    RTI=9,
+)
+
+INSTRUCTION_MEMORY_SIZE = 4096
+MAX_LOOP_NESTING = 8
+MAX_SUBROUTINE_NESTING = 8
+MAX_LOOP_REPETITIONS = 2**20 - 1
+MIN_INSTRUCTION_CYCLES = 5
+
+_STATUS_STOPPED = 2**0
+_STATUS_RESET = 2**1
+_STATUS_RUNNING = 2**2
+_STATUS_WAITING = 2**3
+
+
+class SimulationError(Exception):
+    pass
+
+
+class SimulatedBoard:
+    """In memory model of a PulseBlaster board.
+
+    Attributes:
+        memory: The instruction memory of the board.
+            Each instruction is stored as a tuple (flags, inst, data, length in ns),
+            or None if nothing was ever written at this address.
+            Like on the hardware, starting a new program does not clear the
+            instructions that are not overwritten.
+        write_count: The total number of instructions written to the board.
+        reset_time: The value of `time.monotonic()` when the board was last reset.
+        start_time: The value of `time.monotonic()` when the board was last
+            started.
+    """
+
+    def __init__(self, memory_size: int = INSTRUCTION_MEMORY_SIZE):
+        self.memory: list[Optional[tuple[int, int, int, float]]] = [
+            None
+        ] * memory_size
+        self.write_count = 0
+        self.initialized = False
+        self.clock_frequency = 100.0  # MHz
+        self._write_address: Optional[int] = None
+        self._loop_stack: list[int] = []
+        self._status = _STATUS_STOPPED
+        self._end_time = 0.0
+        # Time in ns that the program takes after the WAIT instruction, or None if
+        # the board is not waiting for a trigger.
+        self._duration_after_wait: Optional[float] = None
+        self._wait_time: Optional[float] = None
+        self.reset_time: Optional[float] = None
+        self.start_time: Optional[float] = None
+
+    @property
+    def clock_cycle(self) -> float:
+        return 1e3 / self.clock_frequency
+
+    def start_programming(self) -> None:
+        self._write_address = 0
+        self._loop_stack = []
+
+    def write_instruction(self, flags: int, inst: int, data: int, length: float) -> int:
+        if self._write_address is None:
+            raise SimulationError("Board is not in programming mode")
+        address = self._write_address
+        if address >= len(self.memory):
+            raise SimulationError(
+                f"Instruction memory is full ({len(self.memory)} instructions)"
+            )
+        if not 0 <= flags < 2**24:
+            raise SimulationError(f"Invalid flags {flags}")
+        if length < MIN_INSTRUCTION_CYCLES * self.clock_cycle:
+            raise SimulationError(
+                f"Instruction length {length} ns is shorter than "
+                f"{MIN_INSTRUCTION_CYCLES} clock cycles"
+            )
+        if inst == Inst.LOOP:
+            if not 1 <= data <= MAX_LOOP_REPETITIONS:
+                raise SimulationError(f"Invalid number of loop repetitions {data}")
+            self._loop_stack.append(address)
+            if len(self._loop_stack) > MAX_LOOP_NESTING:
+                raise SimulationError(
+                    f"Loops can't be nested more than {MAX_LOOP_NESTING} times"
+                )
+        elif inst == Inst.END_LOOP:
+            if not self._loop_stack or self._loop_stack.pop() != data:
+                raise SimulationError(
+                    f"END_LOOP at address {address} doesn't close the innermost loop"
+                )
+        elif inst == Inst.WAIT:
+            if address == 0:
+                raise SimulationError("WAIT can't be the first instruction")
+        elif inst == Inst.LONG_DELAY:
+            if data < 2:
+                raise SimulationError("Long delay multiplier must be at least 2")
+        elif inst not in (
+            Inst.CONTINUE,
+            Inst.STOP,
+            Inst.JSR,
+            Inst.RTS,
+        ):
+            raise SimulationError(f"Instruction {inst} is not supported")
+        self.memory[address] = (flags, inst, data, length)
+        self._write_address += 1
+        self.write_count += 1
+        return address
+
+    def stop_programming(self) -> None:
+        if self._write_address is None:
+            raise SimulationError("Board is not in programming mode")
+        # Loops may be left open here, since only the beginning of the memory might
+        # have been rewritten.
+        # They are checked when the program is executed.
+        self._write_address = None
+
+    def reset(self) -> None:
+        self.reset_time = time.monotonic()
+        self._status = _STATUS_RESET
+
+    def start(self) -> None:
+        self.start_time = time.monotonic()
+        duration = self.run_duration()
+        if self._wait_time is None:
+            self._end_time = self.start_time + duration * 1e-9
+            self._status = _STATUS_RUNNING
+        else:
+            # The time spent before the WAIT instruction is neglected.
+            self._duration_after_wait = duration - self._wait_time
+            self._status = _STATUS_WAITING
+
+    def trigger(self) -> None:
+        """Release the board if it is waiting for a hardware trigger."""
+
+        if self._status == _STATUS_WAITING:
+            self._end_time = time.monotonic() + self._duration_after_wait * 1e-9
+            self._duration_after_wait = None
+            self._status = _STATUS_RUNNING
+
+    def stop(self) -> None:
+        self._duration_after_wait = None
+        self._status = _STATUS_STOPPED
+
+    def read_status(self) -> int:
+        if self._status == _STATUS_RUNNING and time.monotonic() >= self._end_time:
+            self._status = _STATUS_STOPPED
+        return self._status
+
+    def run_duration(self) -> float:
+        """Compute the time in ns taken by the program until it reaches STOP.
+
+        This doesn't include the time spent waiting for a trigger.
+        """
+
+        self._wait_time = None
+        duration, address = self._execute(0, loop_depth=0, call_depth=0)
+        opcode = self._read(address)[1]
+        if opcode != Inst.STOP:
+            raise SimulationError(
+                f"Unexpected instruction {opcode} at address {address} in main program"
+            )
+        return duration
+
+    def _read(self, address: int) -> tuple[int, int, int, float]:
+        if not 0 <= address < len(self.memory):
+            raise SimulationError(f"Address {address} is out of memory")
+        instruction = self.memory[address]
+        if instruction is None:
+            raise SimulationError(f"No instruction at address {address}")
+        return instruction
+
+    def _execute(
+        self, address: int, loop_depth: int, call_depth: int
+    ) -> tuple[float, int]:
+        """Execute instructions from address until a STOP, END_LOOP or RTS.
+
+        Returns:
+            The time elapsed before reaching the terminating instruction, and its
+            address.
+        """
+
+        duration = 0.0
+        while True:
+            _, inst, data, length = self._read(address)
+            if inst in (Inst.STOP, Inst.END_LOOP, Inst.RTS):
+                return duration, address
+            elif inst == Inst.CONTINUE:
+                duration += length
+            elif inst == Inst.WAIT:
+                if loop_depth > 0 or call_depth > 0 or self._wait_time is not None:
+                    raise SimulationError(
+                        f"WAIT at address {address} is only supported once in the "
+                        f"main program"
+                    )
+                # The board waits before outputting this instruction.
+                self._wait_time = duration
+                duration += length
+            elif inst == Inst.LONG_DELAY:
+                duration += length * data
+            elif inst == Inst.LOOP:
+                if loop_depth >= MAX_LOOP_NESTING:
+                    raise SimulationError("Loop nesting limit exceeded")
+                body, end = self._execute(address + 1, loop_depth + 1, call_depth)
+                _, end_inst, end_data, end_length = self._read(end)
+                if end_inst != Inst.END_LOOP or end_data != address:
+                    raise SimulationError(f"Loop at address {address} is not closed")
+                duration += data * (length + body + end_length)
+                address = end
+            elif inst == Inst.JSR:
+                if call_depth >= MAX_SUBROUTINE_NESTING:
+                    raise SimulationError("Subroutine nesting limit exceeded")
+                body, end = self._execute(data, loop_depth, call_depth + 1)
+                _, end_inst, _, end_length = self._read(end)
+                if end_inst != Inst.RTS:
+                    raise SimulationError(f"Subroutine at {data} doesn't return")
+                duration += length + body + end_length
+            else:
+                raise SimulationError(f"Can't execute instruction {inst}")
+            address += 1
+
+
+board_count = 1
+_boards: dict[int, SimulatedBoard] = {}
+_selected_board = 0
+_error = ""
+
+
+def reset_simulation(
+    number_of_boards: int = 1, memory_size: int = INSTRUCTION_MEMORY_SIZE
+) -> None:
+    """Forget the state of all the simulated boards.
+
+    Args:
+        number_of_boards: The number of boards reported by `pb_count_boards`.
+        memory_size: The number of instructions that each board can hold.
+    """
+
+    global board_count, _selected_board, _error
+    board_count = number_of_boards
+    _boards.clear()
+    for board_number in range(number_of_boards):
+        _boards[board_number] = SimulatedBoard(memory_size)
+    _selected_board = 0
+    _error = ""
+
+
+def get_board(board_number: int) -> SimulatedBoard:
+    """Return the simulated board with the given number."""
+
+    return _boards[board_number]
+
+
+def send_trigger(board_number: int = 0) -> None:
+    """Simulate a hardware trigger on the HW_Trigger input of a board."""
+
+    _boards[board_number].trigger()
+
+
+def _call(function, *args) -> int:
+    global _error
+    try:
+        result = function(*args)
+    except SimulationError as e:
+        _error = str(e)
+        logger.debug(f"Simulated spinapi error: {e}")
+        return -1
+    _error = ""
+    return 0 if result is None else result
+
+
+def pb_get_version():
+    """Return library version as UTF-8 encoded string."""
+    return "simulated"
+
+
+def pb_get_error():
+    """Return library error as UTF-8 encoded string."""
+    return _error
+
+
+def pb_count_boards():
+    """Return the number of boards detected in the system."""
+    return board_count
+
+
+def pb_init():
+    """Initialize currently selected board."""
+
+    def init():
+        _boards[_selected_board].initialized = True
+
+    return _call(init)
+
+
+def pb_set_debug(debug):
+    return 0
+
+
+def pb_select_board(board_number):
+    """Select a specific board number"""
+    global _selected_board, _error
+    if not 0 <= board_number < board_count:
+        _error = f"Board {board_number} doesn't exist"
+        return -1
+    _selected_board = board_number
+    return 0
+
+
+def pb_set_defaults():
+    """Set board defaults. Must be called before using any other board functions."""
+    return 0
+
+
+def set_memory_size(memory_size):
+    """Set the number of instructions that the selected board can hold.
+
+    This has no equivalent in spinapi, where the memory size is fixed by the model
+    of the board.
+    The content of the memory is cleared.
+    """
+
+    _boards[_selected_board].memory = [None] * memory_size
+    return 0
+
+
+def pb_core_clock(clock):
+    _boards[_selected_board].clock_frequency = float(clock)
+    return 0
+
+
+def pb_write_register(address, value):
+    return 0
+
+
+def pb_start_programming(target):
+    def start_programming():
+        if target != PULSE_PROGRAM:
+            raise SimulationError(f"Programming target {target} is not supported")
+        _boards[_selected_board].start_programming()
+
+    return _call(start_programming)
+
+
+def pb_stop_programming():
+    return _call(_boards[_selected_board].stop_programming)
+
+
+def pb_read_status():
+    return _boards[_selected_board].read_status()
+
+
+def pb_inst_pbonly(*args):
+    flags, inst, data, length = args
+    return _call(
+        _boards[_selected_board].write_instruction,
+        int(flags),
+        int(inst),
+        int(data),
+        float(length),
+    )
+
+
+def pb_inst_radio(*args):
+    global _error
+    _error = "pb_inst_radio is not supported by the simulation"
+    return -1
+
+
+def pb_inst_dds2(*args):
+    global _error
+    _error = "pb_inst_dds2 is not supported by the simulation"
+    return -1
+
+
+def pb_start():
+    return _call(_boards[_selected_board].start)
+
+
+def pb_stop():
+    return _call(_boards[_selected_board].stop)
+
+
+def pb_reset():
+    return _call(_boards[_selected_board].reset)
+
+
+def pb_close():
+    def close():
+        _boards[_selected_board].initialized = False
+
+    return _call(close)
+
+
+reset_simulation()
@@ -0,0 +1,73 @@
+import pytest
+
+from caqtus.shot_compilation.timed_instructions import Repeated, Concatenated
+from caqtus.types.recoverable_exceptions import InvalidValueError
+from caqtus_devices.pulse_generators.spincore_pulse_blaster._compiler import (
+    lower_within_budget,
+)
+from caqtus_devices.pulse_generators.spincore_pulse_blaster.runtime import (
+    INSTRUCTION_MEMORY_SIZE,
+    estimate_program_size,
+)
+from .test_lowering import digital_pattern
+
+
+def lower(sequence, memory_size=INSTRUCTION_MEMORY_SIZE):
+    return lower_within_budget(
+        sequence,
+        device_name="spincore",
+        time_step=50,
+        wait_for_trigger=False,
+        memory_size=memory_size,
+    )
+
+
+def test_compressible_sequence_is_accepted():
+    sequence = digital_pattern([0, 1] * 5_000)
+
+    program = lower(sequence)
+
+    assert len(program) <= INSTRUCTION_MEMORY_SIZE
+
+
+def test_sequence_over_budget_is_rejected():
+    # Each step has a different value, so the pattern can't be compressed.
+    sequence = digital_pattern(list(range(5_000)))
+
+    with pytest.raises(InvalidValueError) as exc_info:
+        lower(sequence)
+
+    message = str(exc_info.value)
+    # 5000 continue instructions and the final stop instruction.
+    assert "5001" in message
+    assert str(INSTRUCTION_MEMORY_SIZE) in message
+
+
+def test_larger_memory_accepts_sequence():
+    sequence = digital_pattern(list(range(5_000)))
+
+    program = lower(sequence, memory_size=32 * 1024)
+
+    assert len(program) == 5001
+
+
+def test_nested_repeats_are_checked_after_lowering():
+    # The outer loop lowers all but the first and last steps of the inner repeat,
+    # which cuts through it, so the incompressible body is emitted several times.
+    body = digital_pattern(list(range(3_000)))
+    sequence = Repeated(2, Repeated(3, body))
+    assert estimate_program_size(sequence).instructions <= INSTRUCTION_MEMORY_SIZE
+
+    with pytest.raises(InvalidValueError) as exc_info:
+        lower(sequence)
+
+    assert str(INSTRUCTION_MEMORY_SIZE) in str(exc_info.value)
+
+
+def test_too_many_nested_loops_are_rejected():
+    sequence = digital_pattern([1, 2])
+    for _ in range(9):
+        sequence = Repeated(2, Concatenated(sequence, digital_pattern([4])))
+
+    with pytest.raises(InvalidValueError):
+        lower(sequence)
@@ -0,0 +1,168 @@
+import numpy as np
+
+from caqtus.shot_compilation.timed_instructions import (
+    Pattern,
+    Repeated,
+    Concatenated,
+)
+from caqtus_devices.pulse_generators.spincore_pulse_blaster.runtime.lowering import (
+    lower_sequence,
+    Opcode,
+    pack_flags,
+    estimate_program_size,
+)
+
+CHANNEL_NUMBER = 24
+TIME_STEP = 50
+CLOCK_CYCLE = 10
+
+
+def digital_pattern(flags: list[int]) -> Pattern:
+    """Build a pattern where bit i of each flag word is the state of channel i."""
+
+    dtype = np.dtype([(f"ch {channel}", np.bool_) for channel in range(24)])
+    array = np.zeros(len(flags), dtype=dtype)
+    for channel in range(CHANNEL_NUMBER):
+        array[f"ch {channel}"] = [(flag >> channel) & 1 for flag in flags]
+    return Pattern.create_without_copy(array)
+
+
+def lower(sequence):
+    return lower_sequence(
+        sequence,
+        time_step=TIME_STEP,
+        clock_cycle=CLOCK_CYCLE,
+        channel_number=CHANNEL_NUMBER,
+    )
+
+
+def test_pack_flags():
+    flags = [0, 1, 2**23, 0b1011]
+    pattern = digital_pattern(flags)
+
+    assert pack_flags(pattern.array, CHANNEL_NUMBER).tolist() == flags
+    assert int(pack_flags(pattern[3], CHANNEL_NUMBER)) == 0b1011
+
+
+def test_identical_steps_are_merged():
+    program = lower(digital_pattern([1, 1, 1, 2, 2, 1]))
+
+    instructions = program.instructions
+    assert instructions["opcode"].tolist() == [
+        Opcode.CONTINUE,
+        Opcode.CONTINUE,
+        Opcode.CONTINUE,
+        Opcode.STOP,
+    ]
+    assert instructions["flags"].tolist() == [1, 2, 1, 1]
+    assert instructions["duration"].tolist() == [150, 100, 50, 50]
+    assert program.number_ticks == 6
+
+
+def test_loop():
+    sequence = Concatenated(
+        digital_pattern([4]), Repeated(3, digital_pattern([1, 2, 2, 3]))
+    )
+    instructions = lower(sequence).instructions
+
+    assert instructions["opcode"].tolist() == [
+        Opcode.CONTINUE,
+        Opcode.LOOP,
+        Opcode.CONTINUE,
+        Opcode.END_LOOP,
+        Opcode.STOP,
+    ]
+    assert instructions["flags"].tolist() == [4, 1, 2, 3, 3]
+    assert instructions["data"].tolist() == [0, 3, 0, 1, 0]
+    assert instructions["duration"].tolist() == [50, 50, 100, 50, 50]
+
+
+def test_long_duration_is_split():
+    max_number_ticks = (2**32 - 1) // (TIME_STEP // CLOCK_CYCLE)
+    instructions = lower(
+        Repeated(2 * max_number_ticks + 7, digital_pattern([5]))
+    ).instructions
+
+    assert instructions["opcode"].tolist() == [
+        Opcode.LONG_DELAY,
+        Opcode.CONTINUE,
+        Opcode.STOP,
+    ]
+    assert instructions["data"][0] == 4
+    assert instructions["duration"][0] == max_number_ticks * TIME_STEP // 2
+    assert instructions["duration"][1] == 7 * TIME_STEP
+
+
+def test_digest():
+    first = lower(digital_pattern([1, 2, 3]))
+    second = lower(digital_pattern([1, 2, 3]))
+    third = lower(digital_pattern([1, 2, 2]))
+
+    assert first.digest() == second.digest()
+    assert first.digest() != third.digest()
+
+
+def test_periodic_pattern_is_looped():
+    program = lower(digital_pattern([1, 2, 2] * 10 + [4]))
+
+    instructions = program.instructions
+    assert instructions["opcode"].tolist() == [
+        Opcode.LOOP,
+        Opcode.END_LOOP,
+        Opcode.CONTINUE,
+        Opcode.STOP,
+    ]
+    assert instructions["flags"].tolist() == [1, 2, 4, 4]
+    assert instructions["data"].tolist() == [10, 0, 0, 0]
+    assert instructions["duration"].tolist() == [50, 100, 50, 50]
+
+
+def test_repeated_block_is_called_as_subroutine():
+    block = digital_pattern([1, 2, 3, 4])
+    sequence = Concatenated(block, digital_pattern([8]), block)
+    instructions = lower(sequence).instructions
+
+    assert instructions["opcode"].tolist() == [
+        Opcode.JSR,
+        Opcode.CONTINUE,
+        Opcode.JSR,
+        Opcode.STOP,
+        Opcode.CONTINUE,
+        Opcode.CONTINUE,
+        Opcode.RTS,
+    ]
+    assert instructions["flags"].tolist() == [1, 8, 1, 4, 2, 3, 4]
+    assert instructions["data"].tolist() == [4, 0, 4, 0, 0, 0, 0]
+
+
+def test_size_estimate_bounds_lowered_program():
+    sequence = Concatenated(
+        digital_pattern([1, 2, 2, 3]),
+        Repeated(
+            1000,
+            Concatenated(digital_pattern([4, 8]), Repeated(5, digital_pattern([1, 2]))),
+        ),
+    )
+    size = estimate_program_size(sequence)
+
+    assert size.loop_nesting == 2
+    assert len(lower(sequence)) <= size.instructions
+
+
+def test_program_waits_for_trigger():
+    program = lower_sequence(
+        Concatenated(digital_pattern([1, 2]), Repeated(3, digital_pattern([4, 8]))),
+        time_step=TIME_STEP,
+        clock_cycle=CLOCK_CYCLE,
+        channel_number=CHANNEL_NUMBER,
+        wait_for_trigger=True,
+    )
+
+    instructions = program.instructions
+    assert instructions["opcode"].tolist()[:3] == [
+        Opcode.CONTINUE,
+        Opcode.WAIT,
+        Opcode.CONTINUE,
+    ]
+    assert instructions["flags"].tolist()[:3] == [1, 1, 2]
+    assert program.number_ticks == 8
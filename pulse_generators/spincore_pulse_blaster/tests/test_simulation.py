@@ -0,0 +1,181 @@
+import decimal
+import time
+
+import pytest
+
+from caqtus.device.sequencer.trigger import ExternalTriggerStart, TriggerEdge
+from caqtus.shot_compilation.timed_instructions import Concatenated, Repeated
+from caqtus_devices.pulse_generators.spincore_pulse_blaster.runtime import (
+    SpincorePulseBlaster,
+    simulated_spinapi,
+    run_together,
+)
+from caqtus_devices.pulse_generators.spincore_pulse_blaster.runtime.board_manager import (  # noqa: E501
+    SpincoreBoardManager,
+)
+from caqtus_devices.pulse_generators.spincore_pulse_blaster.runtime.runtime import (
+    SpincoreStatus,
+)
+from .test_lowering import digital_pattern
+
+
+@pytest.fixture
+def device():
+    simulated_spinapi.reset_simulation()
+    with SpincorePulseBlaster(
+        name="spincore", time_step=decimal.Decimal(50), simulate=True, memory_size=16
+    ) as device:
+        yield device
+
+
+def test_run_duration(device):
+    sequence = Concatenated(
+        digital_pattern([1, 2, 2]), Repeated(1000, digital_pattern([4, 8]))
+    )
+    device.program_sequence(sequence)
+
+    board = simulated_spinapi.get_board(0)
+    assert board.run_duration() == 50 * len(sequence)
+
+
+def test_sequence_finishes(device):
+    programmed = device.program_sequence(Repeated(10_000, digital_pattern([1, 0])))
+    with programmed.run() as status:
+        status.block_until_finished()
+        assert status.is_finished()
+
+
+def test_identical_sequence_is_not_reprogrammed(device):
+    sequence = digital_pattern([1, 2, 3])
+    device.program_sequence(sequence)
+    device.program_sequence(sequence)
+
+    assert simulated_spinapi.get_board(0).write_count == 4
+    assert device.program_cache_hits == 1
+    assert device.program_cache_misses == 1
+
+
+def test_memory_overflow(device):
+    with pytest.raises(RuntimeError):
+        device.program_sequence(digital_pattern(list(range(20))))
+
+
+def test_differential_programming():
+    simulated_spinapi.reset_simulation()
+    with SpincorePulseBlaster(
+        name="spincore",
+        time_step=decimal.Decimal(50),
+        simulate=True,
+        differential_programming=True,
+    ) as device:
+        tail = digital_pattern([2, 3, 4, 5])
+        device.program_sequence(Concatenated(Repeated(3, digital_pattern([1])), tail))
+        device.program_sequence(Concatenated(Repeated(5, digital_pattern([1])), tail))
+
+        board = simulated_spinapi.get_board(0)
+        assert board.write_count == 6 + 1
+        assert board.run_duration() == 50 * 9
+
+
+def test_two_boards_are_programmed_independently():
+    simulated_spinapi.reset_simulation(number_of_boards=2)
+    with SpincorePulseBlaster(
+        name="first", time_step=decimal.Decimal(50), board_number=0, simulate=True
+    ) as first, SpincorePulseBlaster(
+        name="second", time_step=decimal.Decimal(50), board_number=1, simulate=True
+    ) as second:
+        first.program_sequence(digital_pattern([1, 2]))
+        second.program_sequence(digital_pattern([4, 4, 8]))
+
+        assert simulated_spinapi.get_board(0).run_duration() == 100
+        assert simulated_spinapi.get_board(1).run_duration() == 150
+
+        with second.program_sequence(digital_pattern([4, 4, 8])).run() as status:
+            status.block_until_finished()
+
+
+def test_two_boards_start_together():
+    simulated_spinapi.reset_simulation(number_of_boards=2)
+    with SpincorePulseBlaster(
+        name="first", time_step=decimal.Decimal(50), board_number=0, simulate=True
+    ) as first, SpincorePulseBlaster(
+        name="second", time_step=decimal.Decimal(50), board_number=1, simulate=True
+    ) as second:
+        first_sequence = first.program_sequence(digital_pattern([1, 2]))
+        second_sequence = second.program_sequence(digital_pattern([4, 4, 8]))
+
+        with run_together(first_sequence, second_sequence) as statuses:
+            for status in statuses:
+                status.block_until_finished()
+
+        boards = [simulated_spinapi.get_board(0), simulated_spinapi.get_board(1)]
+        # No board is started before all of them are reset.
+        assert max(board.reset_time for board in boards) <= min(
+            board.start_time for board in boards
+        )
+
+
+def test_sequences_on_the_same_board_cant_run_together(device):
+    sequence = device.program_sequence(digital_pattern([1, 2]))
+    with pytest.raises(ValueError):
+        with run_together(sequence, sequence):
+            pass
+
+
+def test_sequence_waits_for_trigger():
+    simulated_spinapi.reset_simulation()
+    with SpincorePulseBlaster(
+        name="spincore",
+        time_step=decimal.Decimal(50),
+        simulate=True,
+        trigger=ExternalTriggerStart(edge=TriggerEdge.FALLING),
+    ) as device:
+        programmed = device.program_sequence(digital_pattern([1, 2, 3]))
+        with programmed.run() as status:
+            time.sleep(0.01)
+            # The board is armed, but the sequence doesn't start before the trigger.
+            assert not status.is_finished()
+
+            simulated_spinapi.send_trigger(0)
+            status.block_until_finished()
+            assert status.is_finished()
+
+
+
+def test_stop_continues_after_a_board_fails():
+    simulated_spinapi.reset_simulation(number_of_boards=2)
+    manager = SpincoreBoardManager(simulated_spinapi)
+    for board_number in (0, 1):
+        with manager.select(board_number) as spinapi:
+            spinapi.pb_start_programming(spinapi.PULSE_PROGRAM)
+            spinapi.pb_inst_pbonly(0, spinapi.Inst.LONG_DELAY, 1000, 10 * spinapi.ms)
+            spinapi.pb_inst_pbonly(0, spinapi.Inst.STOP, 0, 50)
+            spinapi.pb_stop_programming()
+    manager.start([0, 1])
+
+    with pytest.raises(RuntimeError, match="board 5"):
+        manager.stop([5, 0, 1])
+
+    # The boards after the one that can't be selected are still stopped.
+    for board_number in (0, 1):
+        with manager.select(board_number) as spinapi:
+            assert not spinapi.pb_read_status() & SpincoreStatus.Running
+
+
+def test_untriggered_board_is_stopped_when_run_block_exits():
+    simulated_spinapi.reset_simulation()
+    with SpincorePulseBlaster(
+        name="spincore",
+        time_step=decimal.Decimal(50),
+        simulate=True,
+        trigger=ExternalTriggerStart(edge=TriggerEdge.FALLING),
+    ) as device:
+        programmed = device.program_sequence(digital_pattern([1, 2, 3]))
+        start = time.monotonic()
+        with pytest.raises(RuntimeError):
+            with programmed.run():
+                pass
+
+        assert time.monotonic() - start < 1
+        status = simulated_spinapi.get_board(0).read_status()
+        assert not status & (SpincoreStatus.Running | SpincoreStatus.Waiting)
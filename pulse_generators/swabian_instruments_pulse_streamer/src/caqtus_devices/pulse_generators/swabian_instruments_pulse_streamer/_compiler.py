@@ -1,8 +1,20 @@
+from collections.abc import Mapping
+from typing import Any
+
 from caqtus.device import DeviceName
 from caqtus.device.sequencer import SequencerCompiler
-from caqtus.shot_compilation import SequenceContext
+from caqtus.shot_compilation import SequenceContext, ShotContext
+from caqtus.shot_compilation.timed_instructions import TimedInstruction
+from caqtus.types.recoverable_exceptions import InvalidValueError
 
 from .configuration import SwabianPulseStreamerConfiguration
+from .runtime import (
+    SwabianPulseStreamer,
+    EncodedSequence,
+    encode_sequence,
+    collapse_periodic,
+    MAX_PULSES,
+)
 
 
 class SwabianPulseStreamerCompiler(SequencerCompiler):
@@ -22,4 +34,38 @@ class SwabianPulseStreamerCompiler(SequencerCompiler):
             **super().compile_initialization_parameters(),
             "name": self.device_name,
             "ip_address": self.configuration.ip_address,
+            "simulate": self.configuration.simulate,
         }
+
+    def compile_shot_parameters(self, shot_context: ShotContext) -> Mapping[str, Any]:
+        parameters = super().compile_shot_parameters(shot_context)
+
+        # The sequence is encoded into run-length arrays here, so that the device
+        # server only has to build the pulse lists and upload them.
+        encoded = self.encode_within_budget(parameters["sequence"])
+        return {**parameters, "sequence": encoded}
+
+    def encode_within_budget(self, sequence: TimedInstruction) -> EncodedSequence:
+        """Encode a sequence, checking that it fits in the memory of the device.
+
+        If the sequence needs more pulses than the device can hold, it is
+        compressed by letting the device repeat its periodic part.
+
+        Raises:
+            InvalidValueError: If the sequence still doesn't fit in the device
+                memory once compressed.
+        """
+
+        encoded = encode_sequence(sequence, SwabianPulseStreamer.channel_number)
+        if (
+            encoded.max_number_of_pulses() > MAX_PULSES
+            and encoded.number_of_pulses() > MAX_PULSES
+        ):
+            encoded = collapse_periodic(encoded)
+            number_of_pulses = encoded.number_of_pulses()
+            if number_of_pulses > MAX_PULSES:
+                raise InvalidValueError(
+                    f"The sequence for {self.device_name} needs {number_of_pulses} "
+                    f"pulses, but the device can only hold {MAX_PULSES}"
+                )
+        return encoded
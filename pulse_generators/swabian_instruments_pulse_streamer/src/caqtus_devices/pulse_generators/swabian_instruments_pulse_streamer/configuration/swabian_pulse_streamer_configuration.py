@@ -5,6 +5,7 @@ import attrs
 from caqtus.device.sequencer import (
     SequencerConfiguration,
     DigitalChannelConfiguration,
+    AnalogChannelConfiguration,
 )
 from caqtus.device.sequencer import converter
 from caqtus.device.sequencer.channel_commands import Constant
@@ -14,22 +15,81 @@ from caqtus.types.expression import Expression
 from ..runtime import SwabianPulseStreamer
 
 
+def _default_analog_channel() -> AnalogChannelConfiguration:
+    return AnalogChannelConfiguration(
+        description="", output_unit="V", output=Constant(Expression("0 V"))
+    )
+
+
+def _convert_channels(
+    channels,
+) -> tuple[DigitalChannelConfiguration | AnalogChannelConfiguration, ...]:
+    channels = tuple(channels)
+    # Configurations saved before the analog outputs were supported only have the
+    # digital channels.
+    if len(channels) == SwabianPulseStreamer.digital_channel_number:
+        channels += tuple(
+            _default_analog_channel()
+            for _ in range(
+                SwabianPulseStreamer.channel_number
+                - SwabianPulseStreamer.digital_channel_number
+            )
+        )
+    return channels
+
+
 @attrs.define
 class SwabianPulseStreamerConfiguration(SequencerConfiguration[SwabianPulseStreamer]):
-    number_channels: ClassVar[int] = 8
+    """Holds the static configuration of a Swabian Pulse Streamer.
+
+    Attributes:
+        ip_address: The IP address of the device.
+        channels: The configuration of the 8 digital channels, followed by the 2
+            analog channels.
+            The analog channels must be in volts and stay within +/-1 V.
+        simulate: If True, the device is simulated in memory instead of being
+            accessed over the network.
+    """
+
+    number_channels: ClassVar[int] = SwabianPulseStreamer.channel_number
+    number_digital_channels: ClassVar[int] = SwabianPulseStreamer.digital_channel_number
 
     ip_address: str = attrs.field(converter=str, on_setattr=attrs.setters.convert)
 
-    channels: tuple[DigitalChannelConfiguration, ...] = attrs.field(
-        converter=tuple,
-        validator=attrs.validators.deep_iterable(
-            member_validator=attrs.validators.instance_of(DigitalChannelConfiguration)
-        ),
-        on_setattr=attrs.setters.pipe(attrs.setters.convert, attrs.setters.validate),
+    channels: tuple[DigitalChannelConfiguration | AnalogChannelConfiguration, ...] = (
+        attrs.field(
+            converter=_convert_channels,
+            validator=attrs.validators.deep_iterable(
+                member_validator=attrs.validators.instance_of(
+                    (DigitalChannelConfiguration, AnalogChannelConfiguration)
+                )
+            ),
+            on_setattr=attrs.setters.pipe(
+                attrs.setters.convert, attrs.setters.validate
+            ),
+        )
     )
+    simulate: bool = attrs.field(
+        default=False, converter=bool, on_setattr=attrs.setters.convert
+    )
+
+    def channel_types(
+        self,
+    ) -> tuple[type[DigitalChannelConfiguration | AnalogChannelConfiguration], ...]:
+        number_analog_channels = self.number_channels - self.number_digital_channels
+        return (DigitalChannelConfiguration,) * self.number_digital_channels + (
+            AnalogChannelConfiguration,
+        ) * number_analog_channels
 
-    def channel_types(self) -> tuple[type[DigitalChannelConfiguration], ...]:
-        return (DigitalChannelConfiguration,) * self.number_channels
+    @channels.validator  # type: ignore
+    def validate_channels(self, attribute, channels):
+        super().validate_channels(attribute, channels)
+        for channel in channels[self.number_digital_channels :]:
+            if channel.output_unit != "V":
+                raise ValueError(
+                    f"Channel {channel} output units ({channel.output_unit}) are not"
+                    " compatible with Volt"
+                )
 
     @classmethod
     def dump(cls, config: Self):
@@ -50,6 +110,10 @@ class SwabianPulseStreamerConfiguration(SequencerConfiguration[SwabianPulseStrea
                 DigitalChannelConfiguration(
                     description="", output=Constant(Expression("Disabled"))
                 )
-                for _ in range(cls.number_channels)
+                for _ in range(cls.number_digital_channels)
+            )
+            + tuple(
+                _default_analog_channel()
+                for _ in range(cls.number_channels - cls.number_digital_channels)
             ),
         )
@@ -1,7 +1,7 @@
 import decimal
 from typing import Optional
 
-from PySide6.QtWidgets import QLineEdit, QWidget
+from PySide6.QtWidgets import QCheckBox, QLineEdit, QWidget
 
 from caqtus.gui.condetrol.device_configuration_editors.sequencer_configuration_editor import (
     SequencerConfigurationEditor,
@@ -29,7 +29,12 @@ class SwabianPulseStreamerDeviceConfigEditor(
         self._ip_address.setText(config.ip_address)
         self.form.insertRow(1, "Ip address", self._ip_address)
 
+        self._simulate = QCheckBox(self)
+        self._simulate.setChecked(config.simulate)
+        self.form.insertRow(2, "Simulate", self._simulate)
+
     def get_configuration(self) -> SwabianPulseStreamerConfiguration:
         config = super().get_configuration()
         config.ip_address = self._ip_address.text()
+        config.simulate = self._simulate.isChecked()
         return config
@@ -1,3 +1,15 @@
+from .encoding import (
+    EncodedSequence,
+    encode_sequence,
+    collapse_periodic,
+    MAX_PULSES,
+)
 from .swabian_pulse_streamer import SwabianPulseStreamer
 
-__all__ = ["SwabianPulseStreamer"]
+__all__ = [
+    "SwabianPulseStreamer",
+    "EncodedSequence",
+    "encode_sequence",
+    "collapse_periodic",
+    "MAX_PULSES",
+]
@@ -0,0 +1,335 @@
+"""Device independent encoding of timed instructions for the Pulse Streamer.
+
+The Pulse Streamer describes the output of each channel as a list of
+(duration, level) pairs.
+The functions in this module compute these pairs with NumPy, so that the cost of
+encoding a pattern grows with the number of edges and not with the number of
+samples.
+
+Digital channels have boolean levels, and analog channels have floating point
+levels in volts, quantized to the resolution of the device before being encoded.
+"""
+
+import functools
+import hashlib
+import math
+
+import attrs
+import numpy as np
+
+from caqtus.types.recoverable_exceptions import InvalidValueError
+from caqtus.shot_compilation.timed_instructions import (
+    TimedInstruction,
+    Pattern,
+    Concatenated,
+    Repeated,
+    Ramp,
+)
+
+# Number of pulses that the memory of the device can hold.
+MAX_PULSES = 2_000_000
+
+# The analog outputs cover -1 V to 1 V with 16 bits.
+MAX_ANALOG_VOLTAGE = 1.0
+_ANALOG_STEPS = 2**15 - 1
+ANALOG_RESOLUTION = MAX_ANALOG_VOLTAGE / _ANALOG_STEPS
+
+
+def run_length_encode(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Group consecutive identical values together.
+
+    Args:
+        values: A one-dimensional array of values.
+
+    Returns:
+        A tuple (durations, levels) where levels[i] is held for durations[i]
+        consecutive samples of the input.
+    """
+
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64), values[:0]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(values)) + 1))
+    durations = np.diff(np.append(starts, len(values)))
+    return durations.astype(np.int64, copy=False), values[starts]
+
+
+def quantize_analog(values: np.ndarray, channel: int) -> np.ndarray:
+    """Round analog values in volts to the closest value the device can output.
+
+    Args:
+        values: The values to output on the channel.
+        channel: The index of the channel, used to report invalid values.
+
+    Raises:
+        InvalidValueError: If some values are not finite or outside the range of
+            the outputs.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    if not np.all(np.abs(values) <= MAX_ANALOG_VOLTAGE):
+        raise InvalidValueError(
+            f"The values for analog channel {channel} must be finite and within "
+            f"+/-{MAX_ANALOG_VOLTAGE} V"
+        )
+    steps = np.round(values * (_ANALOG_STEPS / MAX_ANALOG_VOLTAGE))
+    return steps * (MAX_ANALOG_VOLTAGE / _ANALOG_STEPS)
+
+
+def merge_runs(
+    durations: np.ndarray, levels: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Merge adjacent runs that have the same level.
+
+    Runs with zero duration are dropped.
+    """
+
+    non_empty = durations > 0
+    durations = durations[non_empty]
+    levels = levels[non_empty]
+    if len(durations) == 0:
+        return durations, levels
+    starts = np.concatenate(([0], np.flatnonzero(levels[1:] != levels[:-1]) + 1))
+    return np.add.reduceat(durations, starts), levels[starts]
+
+
+@attrs.frozen(eq=False)
+class EncodedSequence:
+    """Runs of each channel of a sequence, ready to be uploaded to the device.
+
+    Attributes:
+        channel_runs: For each channel, a tuple (durations, levels) of arrays.
+            The durations are in ns.
+        repetitions: The number of times the device must play the runs back to
+            back, passed as `n_runs` when streaming the sequence.
+    """
+
+    channel_runs: tuple[tuple[np.ndarray, np.ndarray], ...] = attrs.field(
+        converter=tuple
+    )
+    repetitions: int = attrs.field(default=1, converter=int)
+
+    @property
+    def duration(self) -> int:
+        """The total duration of the sequence, in ns."""
+
+        durations, _ = self.channel_runs[0]
+        return int(durations.sum()) * self.repetitions
+
+    def digest(self) -> bytes:
+        """Return a hash of the content of the encoded sequence.
+
+        Two encoded sequences with the same digest output the same values.
+        """
+
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{len(self.channel_runs)} {self.repetitions}".encode())
+        for durations, levels in self.channel_runs:
+            digest.update(f"{len(durations)} {levels.dtype.str}".encode())
+            digest.update(np.ascontiguousarray(durations, dtype=np.int64).tobytes())
+            digest.update(np.ascontiguousarray(levels).tobytes())
+        return digest.digest()
+
+    def number_of_pulses(self) -> int:
+        """The number of pulses the device needs to store the sequence.
+
+        The device stores a new pulse each time any of the channels changes, so
+        this is the number of distinct run boundaries across all the channels.
+        """
+
+        return len(_pulse_ends(self.channel_runs))
+
+    def max_number_of_pulses(self) -> int:
+        """An upper bound on `number_of_pulses`, cheaper to compute.
+
+        Each pulse boundary is the end of a run of at least one channel, so there
+        can't be more pulses than runs in total.
+        """
+
+        return sum(len(durations) for durations, _ in self.channel_runs)
+
+    def final_levels(self) -> list:
+        """The level of each channel at the end of the sequence.
+
+        The levels are booleans for digital channels and volts for analog channels.
+        """
+
+        return [levels[-1].item() for _, levels in self.channel_runs]
+
+
+def encode_sequence(sequence: TimedInstruction, channel_number: int) -> EncodedSequence:
+    """Encode a sequence, letting the device repeat it when possible.
+
+    When the whole sequence is a repetition of a block, only the block is encoded
+    and the device is asked to play it several times.
+    """
+
+    repetitions = 1
+    while isinstance(sequence, Repeated) and len(sequence.instruction) > 1:
+        repetitions *= sequence.repetitions
+        sequence = sequence.instruction
+    return EncodedSequence(
+        channel_runs=encode_channels(sequence, channel_number),
+        repetitions=repetitions,
+    )
+
+
+def collapse_periodic(encoded: EncodedSequence) -> EncodedSequence:
+    """Fold a sequence made of identical blocks into a single repeated block.
+
+    Returns:
+        A sequence that contains the shortest block such that the original
+        sequence is this block played back to back, with the number of
+        repetitions increased accordingly.
+        If the sequence is not periodic, it is returned unchanged.
+    """
+
+    ends = _pulse_ends(encoded.channel_runs)
+    number_pulses = len(ends)
+    pulse_durations = np.diff(ends, prepend=0)
+    # Level of each channel during each pulse.
+    pulse_levels = [
+        levels[np.searchsorted(np.cumsum(durations), ends, side="left")]
+        for durations, levels in encoded.channel_runs
+    ]
+
+    for period in _divisors(number_pulses):
+        if period == number_pulses:
+            break
+        # Comparing the first two blocks rejects most periods cheaply.
+        if not np.array_equal(
+            pulse_durations[:period], pulse_durations[period : 2 * period]
+        ):
+            continue
+        if np.array_equal(pulse_durations[period:], pulse_durations[:-period]) and all(
+            np.array_equal(levels[period:], levels[:-period])
+            for levels in pulse_levels
+        ):
+            return EncodedSequence(
+                channel_runs=[
+                    merge_runs(pulse_durations[:period], levels[:period])
+                    for levels in pulse_levels
+                ],
+                repetitions=encoded.repetitions * (number_pulses // period),
+            )
+    return encoded
+
+
+def _pulse_ends(channel_runs) -> np.ndarray:
+    return np.unique(
+        np.concatenate([np.cumsum(durations) for durations, _ in channel_runs])
+    )
+
+
+def _divisors(number: int) -> list[int]:
+    small = [
+        divisor for divisor in range(1, math.isqrt(number) + 1) if number % divisor == 0
+    ]
+    return sorted(set(small + [number // divisor for divisor in small]))
+
+
+def encode_channels(
+    sequence: TimedInstruction, channel_number: int
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Compute the runs of each channel of a sequence.
+
+    Args:
+        sequence: The sequence to encode.
+            It must have one field "ch i" for each channel, boolean for digital
+            channels and floating point for analog channels.
+        channel_number: The number of channels to encode.
+
+    Returns:
+        For each channel, a tuple (durations, levels) with no two adjacent runs at
+        the same level.
+    """
+
+    builder = _RunsBuilder(channel_number)
+    _append_runs(sequence, builder)
+    return builder.build()
+
+
+class _RunsBuilder:
+    """Collects the runs of each channel and joins them once at the end.
+
+    Joining all the pieces at once keeps the encoding linear in the number of
+    runs, however many instructions are concatenated.
+    """
+
+    def __init__(self, channel_number: int):
+        self.channel_number = channel_number
+        self._durations: list[list[np.ndarray]] = [[] for _ in range(channel_number)]
+        self._levels: list[list[np.ndarray]] = [[] for _ in range(channel_number)]
+
+    def append(self, channel: int, durations: np.ndarray, levels: np.ndarray) -> None:
+        self._durations[channel].append(durations)
+        self._levels[channel].append(levels)
+
+    def build(self) -> list[tuple[np.ndarray, np.ndarray]]:
+        return [
+            merge_runs(
+                np.concatenate(self._durations[channel]),
+                np.concatenate(self._levels[channel]),
+            )
+            for channel in range(self.channel_number)
+        ]
+
+
+@functools.singledispatch
+def _append_runs(instruction: TimedInstruction, builder: _RunsBuilder) -> None:
+    raise NotImplementedError(
+        f"Can't program instruction with type {type(instruction)}."
+    )
+
+
+def _channel_levels(values: np.ndarray, channel: int) -> np.ndarray:
+    levels = values[f"ch {channel}"]
+    if np.issubdtype(levels.dtype, np.floating):
+        return quantize_analog(levels, channel)
+    return levels
+
+
+@_append_runs.register
+def _(pattern: Pattern, builder: _RunsBuilder) -> None:
+    values = pattern.array
+    for channel in range(builder.channel_number):
+        builder.append(channel, *run_length_encode(_channel_levels(values, channel)))
+
+
+@_append_runs.register
+def _(ramp: Ramp, builder: _RunsBuilder) -> None:
+    # The device can only output steps, so ramps are sampled at each time step and
+    # the runs come from the quantized samples.
+    _append_runs(ramp.to_pattern(), builder)
+
+
+@_append_runs.register
+def _(concatenated: Concatenated, builder: _RunsBuilder) -> None:
+    for instruction in concatenated.instructions:
+        _append_runs(instruction, builder)
+
+
+@_append_runs.register
+def _(repeated: Repeated, builder: _RunsBuilder) -> None:
+    if len(repeated.instruction) == 1:
+        values = repeated.instruction.to_pattern().array
+        for channel in range(builder.channel_number):
+            builder.append(
+                channel,
+                np.array([repeated.repetitions], dtype=np.int64),
+                _channel_levels(values, channel),
+            )
+    else:
+        # The body is only encoded once and its runs are tiled with NumPy.
+        # Channels that are constant during the body are a single long run instead.
+        body_builder = _RunsBuilder(builder.channel_number)
+        _append_runs(repeated.instruction, body_builder)
+        repetitions = repeated.repetitions
+        for channel, (durations, levels) in enumerate(body_builder.build()):
+            if len(durations) == 1:
+                builder.append(channel, durations * repetitions, levels)
+            else:
+                builder.append(
+                    channel,
+                    np.tile(durations, repetitions),
+                    np.tile(levels, repetitions),
+                )
@@ -0,0 +1,218 @@
+"""Pure python stand-in for the `pulsestreamer.PulseStreamer` client.
+
+This module exposes a `SimulatedPulseStreamer` class with the same methods as the
+client used by the runtime, but instead of talking to a device over the network,
+it simulates a Pulse Streamer in memory.
+It models the limited pulse memory of the device, the time taken to upload a
+sequence and the duration of the sequence once started, and records what was
+uploaded.
+Like on the device, forcing the final state releases the uploaded sequence.
+
+It is meant to exercise the runtime without hardware, for tests and benchmarks.
+A device armed for a hardware trigger waits until a trigger is simulated with
+`send_trigger`.
+"""
+
+import logging
+import time
+from typing import Optional
+
+import attrs
+from pulsestreamer import TriggerStart, TriggerRearm, ClockSource
+
+from .encoding import MAX_PULSES
+
+logger = logging.getLogger(__name__)
+
+# Number of pulses transferred per second when uploading a sequence.
+UPLOAD_BANDWIDTH = 1_000_000
+
+
+class SimulationError(Exception):
+    pass
+
+
+@attrs.frozen
+class Upload:
+    """A sequence uploaded to the simulated device.
+
+    Attributes:
+        pulses: The pulses of the sequence, as returned by `Sequence.getData`.
+            Each pulse is a tuple (duration in ns, digital mask, analog 0,
+            analog 1).
+        n_runs: The number of times the sequence is played.
+        final: The state of the outputs after the sequence.
+        upload_time: The time the upload would take on the device, in seconds.
+    """
+
+    pulses: list[tuple[int, int, float, float]]
+    n_runs: int
+    final: object
+    upload_time: float
+
+    @property
+    def duration(self) -> int:
+        """The time taken to play the sequence n_runs times, in ns."""
+
+        return sum(pulse[0] for pulse in self.pulses) * self.n_runs
+
+
+class SimulatedPulseStreamer:
+    """In memory model of a Pulse Streamer.
+
+    Attributes:
+        uploads: All the sequences uploaded to the device, in order.
+        max_pulses: The number of pulses that the memory can hold.
+        upload_bandwidth: The number of pulses uploaded per second.
+        sleep_on_upload: If True, uploading a sequence blocks for the time the
+            transfer would take on the device.
+    """
+
+    def __init__(
+        self,
+        ip_address: str,
+        max_pulses: int = MAX_PULSES,
+        upload_bandwidth: float = UPLOAD_BANDWIDTH,
+        sleep_on_upload: bool = False,
+    ):
+        self.ip_address = ip_address
+        self.uploads: list[Upload] = []
+        self.max_pulses = max_pulses
+        self.upload_bandwidth = upload_bandwidth
+        self.sleep_on_upload = sleep_on_upload
+        self.trigger_start = TriggerStart.SOFTWARE
+        self.trigger_rearm = TriggerRearm.MANUAL
+        self.clock_source = ClockSource.INTERNAL
+        # The sequence held by the device, or None if it was released.
+        self._sequence: Optional[Upload] = None
+        self._armed = False
+        self._end_time: Optional[float] = None
+
+    @property
+    def uploaded_pulses(self) -> int:
+        """The total number of pulses uploaded to the device."""
+
+        return sum(len(upload.pulses) for upload in self.uploads)
+
+    def getFirmwareVersion(self) -> str:
+        return "simulated"
+
+    def setTrigger(self, start, rearm=TriggerRearm.AUTO) -> None:
+        self.trigger_start = start
+        self.trigger_rearm = rearm
+
+    def selectClock(self, source) -> None:
+        self.clock_source = source
+
+    def stream(self, seq, n_runs=1, final=None) -> None:
+        pulses = seq.getData()
+        if len(pulses) > self.max_pulses:
+            raise SimulationError(
+                f"Sequence has {len(pulses)} pulses, but the device memory can "
+                f"only hold {self.max_pulses}"
+            )
+        upload = Upload(
+            pulses=pulses,
+            n_runs=n_runs,
+            final=final,
+            upload_time=len(pulses) / self.upload_bandwidth,
+        )
+        if self.sleep_on_upload:
+            time.sleep(upload.upload_time)
+        self.uploads.append(upload)
+        self._sequence = upload
+        self._arm()
+
+    def startNow(self) -> None:
+        if self._sequence is None:
+            raise SimulationError("No sequence was uploaded")
+        self._start()
+
+    def rearm(self) -> bool:
+        if self.isStreaming() or self._sequence is None:
+            return False
+        self._arm()
+        return True
+
+    def isStreaming(self) -> bool:
+        return self._end_time is not None and time.monotonic() < self._end_time
+
+    def hasSequence(self) -> bool:
+        return self._sequence is not None
+
+    def hasFinished(self) -> bool:
+        return self._end_time is not None and time.monotonic() >= self._end_time
+
+    def forceFinal(self) -> None:
+        if self._end_time is not None:
+            self._end_time = min(self._end_time, time.monotonic())
+        self._armed = False
+        self._sequence = None
+
+    def trigger(self) -> None:
+        """Simulate a hardware trigger.
+
+        The sequence starts if the device is armed for a hardware trigger, otherwise
+        the trigger is ignored.
+        """
+
+        if self._armed:
+            self._armed = False
+            self._start()
+
+    def _arm(self) -> None:
+        # The previous run is forgotten, so that the device doesn't report the
+        # armed sequence as finished.
+        self._end_time = None
+        self._armed = self.trigger_start != TriggerStart.SOFTWARE
+
+    def _start(self) -> None:
+        self._end_time = time.monotonic() + self._sequence.duration * 1e-9
+
+
+_devices: dict[str, SimulatedPulseStreamer] = {}
+_device_options: dict = {}
+
+
+def connect(ip_address: str) -> SimulatedPulseStreamer:
+    """Return the simulated device at the given address.
+
+    Like a real device, the simulated device keeps its state when connecting to
+    it again.
+    """
+
+    if (device := _devices.get(ip_address)) is None:
+        device = SimulatedPulseStreamer(ip_address, **_device_options)
+        _devices[ip_address] = device
+    return device
+
+
+def get_device(ip_address: str) -> SimulatedPulseStreamer:
+    """Return the simulated device at the given address."""
+
+    return _devices[ip_address]
+
+
+def send_trigger(ip_address: str) -> None:
+    """Simulate a hardware trigger on the device at the given address."""
+
+    _devices[ip_address].trigger()
+
+
+def reset_simulation(
+    max_pulses: int = MAX_PULSES,
+    upload_bandwidth: float = UPLOAD_BANDWIDTH,
+    sleep_on_upload: bool = False,
+) -> None:
+    """Forget the state of all the simulated devices.
+
+    The arguments are used for the devices created afterward, see
+    `SimulatedPulseStreamer`.
+    """
+
+    _devices.clear()
+    _device_options.update(
+        max_pulses=max_pulses,
+        upload_bandwidth=upload_bandwidth,
+        sleep_on_upload=sleep_on_upload,
+    )
@@ -1,8 +1,12 @@
+import asyncio
 import contextlib
 import decimal
+import functools
 import logging
-from functools import singledispatchmethod
-from typing import ClassVar, Literal
+import math
+import time
+from collections.abc import Callable
+from typing import ClassVar, Literal, Optional
 
 import attrs.setters
 from attrs import define, field
@@ -29,13 +33,9 @@ from caqtus.device.sequencer.trigger import (
     TriggerEdge,
     SoftwareTrigger,
 )
-from caqtus.shot_compilation.timed_instructions import (
-    TimedInstruction,
-    Pattern,
-    Concatenated,
-    Repeated,
-)
+from caqtus.shot_compilation.timed_instructions import TimedInstruction
 from caqtus.types.recoverable_exceptions import ConnectionFailedError
+from .encoding import EncodedSequence, encode_sequence
 
 logger = logging.getLogger(__name__)
 
@@ -50,10 +50,20 @@ class SwabianPulseStreamer(Sequencer, RuntimeDevice):
             The time step is fixed to 1 ns.
         trigger: Indicates how the sequence is started and how it is clocked.
         clock_source: The hardware clock source of the device.
+        simulate: If True, the device is simulated in memory by the
+            `simulated_pulse_streamer` module instead of being accessed over the
+            network.
+        upload_cache_hits: The number of times program_sequence was called with the
+            sequence already uploaded, so that the upload was skipped.
+        upload_cache_misses: The number of times the sequence had to be uploaded.
+        rpc_latencies: The latency of the calls made to the device, indexed by the
+            name of the method called.
     """
 
-    # only support digital channels at the moment
-    channel_number: ClassVar[int] = 8
+    # Channels 0 to 7 are the digital outputs, channels 8 and 9 are the analog
+    # outputs 0 and 1.
+    channel_number: ClassVar[int] = 10
+    digital_channel_number: ClassVar[int] = 8
 
     ip_address: str = field(validator=instance_of(str), on_setattr=frozen)
     time_step: TimeStep = field(
@@ -67,8 +77,18 @@ class SwabianPulseStreamer(Sequencer, RuntimeDevice):
     clock_source: Literal["internal", "external 10MHz", "external 125MHz"] = field(
         default="external 10MHz", on_setattr=frozen
     )
+    simulate: bool = field(
+        default=False, validator=instance_of(bool), on_setattr=frozen
+    )
+
+    upload_cache_hits: int = field(default=0, init=False)
+    upload_cache_misses: int = field(default=0, init=False)
+    rpc_latencies: dict[str, "RpcLatency"] = field(factory=dict, init=False)
 
     _pulse_streamer: PulseStreamer = field(init=False)
+    # Digest of the sequence last uploaded to the device, or None if the content of
+    # the device is unknown.
+    _uploaded_digest: Optional[bytes] = field(default=None, init=False)
 
     @trigger.validator  # type: ignore
     def _validate_trigger(self, _, value):
@@ -79,7 +99,15 @@ class SwabianPulseStreamer(Sequencer, RuntimeDevice):
         super().initialize()
 
         # There is no close method for the PulseStreamer class
-        self._pulse_streamer = PulseStreamer(self.ip_address)
+        if self.simulate:
+            from . import simulated_pulse_streamer
+
+            pulse_streamer = simulated_pulse_streamer.connect(self.ip_address)
+        else:
+            pulse_streamer = PulseStreamer(self.ip_address)
+        self._pulse_streamer = _TimedPulseStreamer(  # type: ignore
+            pulse_streamer, self.rpc_latencies
+        )
         try:
             self._pulse_streamer.getFirmwareVersion()
         except IOError as e:
@@ -115,94 +143,233 @@ class SwabianPulseStreamer(Sequencer, RuntimeDevice):
             raise ValueError("Only supports software trigger.")
         self._pulse_streamer.setTrigger(start, TriggerRearm.MANUAL)
 
-    def program_sequence(self, sequence: TimedInstruction) -> ProgrammedSequence:
-        seq = self._construct_pulse_streamer_sequence(sequence)
-        last_values = sequence[-1]
+    def program_sequence(
+        self, sequence: TimedInstruction | EncodedSequence
+    ) -> ProgrammedSequence:
+        """Upload a sequence to the device.
+
+        Args:
+            sequence: Either a sequence of instructions, or a sequence that was
+                already encoded with `encode_sequence`, typically by the compiler.
+        """
+
+        if isinstance(sequence, EncodedSequence):
+            encoded = sequence
+        else:
+            encoded = encode_sequence(sequence, self.channel_number)
+        digest = encoded.digest()
+        if digest == self._uploaded_digest and self._rearm():
+            self.upload_cache_hits += 1
+            logger.debug("Sequence already uploaded, skipping upload")
+        else:
+            self.upload_cache_misses += 1
+            # The content of the device is unknown until the upload succeeds.
+            self._uploaded_digest = None
+            self._upload(encoded)
+            self._uploaded_digest = digest
+        return _ProgrammedSequence(
+            self._pulse_streamer,
+            self.trigger,
+            duration=encoded.duration * 1e-9,
+            on_error=self._invalidate_upload_cache,
+        )
+
+    def _upload(self, encoded: EncodedSequence) -> None:
+        seq = self._construct_pulse_streamer_sequence(encoded)
+        final_levels = encoded.final_levels()
+        digital_levels = final_levels[: self.digital_channel_number]
+        analog_levels = final_levels[self.digital_channel_number :]
         enabled_output = [
-            channel
-            for channel in range(self.channel_number)
-            if last_values[f"ch {channel}"]
+            channel for channel, level in enumerate(digital_levels) if level
         ]
-        final_state = OutputState(enabled_output, 0.0, 0.0)
-        self._pulse_streamer.stream(seq=seq, n_runs=1, final=final_state)
-        return _ProgrammedSequence(self._pulse_streamer, self.trigger)
+        final_state = OutputState(enabled_output, *analog_levels)
+        self._pulse_streamer.stream(
+            seq=seq, n_runs=encoded.repetitions, final=final_state
+        )
+
+    def _rearm(self) -> bool:
+        """Prepare the sequence already on the device to be played again.
 
-    @singledispatchmethod
+        Returns:
+            False if the device could not be rearmed, in which case the sequence
+            must be uploaded again.
+        """
+
+        # The device releases its sequence when the final state is forced, or if
+        # another client used it.
+        if isinstance(self.trigger, SoftwareTrigger):
+            # startNow replays the uploaded sequence when the sequence is run, so
+            # there is nothing to arm.
+            return bool(self._pulse_streamer.hasSequence())
+        # rearm fails when there is no sequence on the device, so a single call
+        # is enough to know if the sequence must be uploaded again.
+        return bool(self._pulse_streamer.rearm())
+
+    def _invalidate_upload_cache(self) -> None:
+        self._uploaded_digest = None
+
+    @classmethod
     def _construct_pulse_streamer_sequence(
-        self, instruction: TimedInstruction
+        cls, encoded: EncodedSequence
     ) -> PulseStreamerSequence:
-        raise NotImplementedError(
-            f"Can't program instruction with type {type(instruction)}."
-        )
-
-    @_construct_pulse_streamer_sequence.register
-    def _(self, pattern: Pattern) -> PulseStreamerSequence:
-        sequence = self._pulse_streamer.createSequence()
-        values = pattern.array
-        for channel in range(self.channel_number):
-            channel_values = values[f"ch {channel}"]
-            sequence.setDigital(channel, [(1, v) for v in channel_values])
+        # The sequence is built locally, without asking the device for it.
+        sequence = PulseStreamerSequence()
+        for channel, (durations, levels) in enumerate(encoded.channel_runs):
+            pulses = list(zip(durations.tolist(), levels.tolist(), strict=True))
+            if channel < cls.digital_channel_number:
+                sequence.setDigital(channel, pulses)
+            else:
+                sequence.setAnalog(channel - cls.digital_channel_number, pulses)
         return sequence
 
-    @_construct_pulse_streamer_sequence.register
-    def _(self, concatenate: Concatenated) -> PulseStreamerSequence:
-        instructions = concatenate.instructions
-        seq = self._construct_pulse_streamer_sequence(instructions[0])
-        for instruction in instructions[1:]:
-            seq += self._construct_pulse_streamer_sequence(instruction)
-        return seq
-
-    @_construct_pulse_streamer_sequence.register
-    def _(self, repeat: Repeated) -> PulseStreamerSequence:
-        if len(repeat.instruction) == 1:
-            channel_values = repeat.instruction[0]
-            seq = self._pulse_streamer.createSequence()
-            for channel in range(self.channel_number):
-                seq.setDigital(
-                    channel,
-                    [
-                        (
-                            repeat.repetitions,
-                            channel_values[f"ch {channel}"],
-                        )
-                    ],
-                )
-            return seq
-        else:
-            return (
-                self._construct_pulse_streamer_sequence(repeat.instruction)
-                * repeat.repetitions
-            )
-
 
 class _ProgrammedSequence(ProgrammedSequence):
     def __init__(
         self,
         pulse_streamer: PulseStreamer,
         trigger: Trigger,
+        duration: float,
+        on_error: Callable[[], None],
     ):
+        """
+        Args:
+            pulse_streamer: The device running the sequence.
+            trigger: The trigger used to start the sequence.
+            duration: The duration of the sequence, in seconds.
+            on_error: Called when an error occurs while running the sequence.
+        """
+
         self._pulse_streamer = pulse_streamer
         self._trigger = trigger
+        self._duration = duration
+        self._on_error = on_error
 
     @contextlib.contextmanager
     def run(self):
-        status = _SequenceStatus(self._pulse_streamer)
+        try:
+            with self._run() as status:
+                yield status
+        except BaseException:
+            self._on_error()
+            raise
+
+    @contextlib.contextmanager
+    def _run(self):
         if isinstance(self._trigger, SoftwareTrigger):
             self._pulse_streamer.startNow()
         # Nothing do start if waiting for external trigger
+        status = _SequenceStatus(
+            self._pulse_streamer, time.monotonic() + self._duration
+        )
+        finished = False
         try:
             yield status
             if not status.is_finished():
                 raise RuntimeError(
                     "Run block exited without error before sequence finished"
                 )
+            finished = True
         finally:
-            self._pulse_streamer.forceFinal()
+            # A finished sequence already left the device in its final state.
+            # Forcing it would also release the uploaded sequence, so that it could
+            # not be replayed for the next shot.
+            if not finished:
+                self._pulse_streamer.forceFinal()
 
 
 class _SequenceStatus(SequenceStatus):
-    def __init__(self, pulse_streamer: PulseStreamer):
+    def __init__(self, pulse_streamer: PulseStreamer, expected_end: float):
+        """
+        Args:
+            pulse_streamer: The device running the sequence.
+            expected_end: The value of `time.monotonic()` at which the sequence is
+                expected to finish.
+                The sequence can't finish before this time.
+        """
+
         self._pulse_streamer = pulse_streamer
+        self._expected_end = expected_end
 
     def is_finished(self) -> bool:
+        # The device is only asked once the sequence had time to play, to save a
+        # network round trip for each early poll.
+        # Before that, the sequence is reported as not finished, even if it was
+        # triggered early, which only delays the end of the shot.
+        if time.monotonic() < self._expected_end:
+            return False
         return self._pulse_streamer.hasFinished()
+
+    def block_until_finished(self) -> None:
+        """Wait for the sequence to finish, without holding the processor."""
+
+        time.sleep(self._time_to_expected_end())
+        delay = _MIN_POLL_INTERVAL
+        while not self.is_finished():
+            time.sleep(delay)
+            delay = min(2 * delay, _MAX_POLL_INTERVAL)
+
+    async def wait_finished(self) -> None:
+        """Wait for the sequence to finish, letting other tasks run meanwhile."""
+
+        await asyncio.sleep(self._time_to_expected_end())
+        delay = _MIN_POLL_INTERVAL
+        while not self.is_finished():
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, _MAX_POLL_INTERVAL)
+
+    def _time_to_expected_end(self) -> float:
+        return max(self._expected_end - time.monotonic(), 0.0)
+
+
+@define
+class RpcLatency:
+    """Latency statistics of the calls to a method of the device.
+
+    Attributes:
+        count: The number of calls made.
+        total: The total time spent in the calls, in seconds.
+        maximum: The longest time spent in a single call, in seconds.
+    """
+
+    count: int = 0
+    total: float = 0.0
+    maximum: float = 0.0
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else math.nan
+
+    def record(self, elapsed: float) -> None:
+        self.count += 1
+        self.total += elapsed
+        self.maximum = max(self.maximum, elapsed)
+
+
+class _TimedPulseStreamer:
+    """Forwards the calls to a PulseStreamer, measuring how long each one takes."""
+
+    def __init__(self, pulse_streamer: PulseStreamer, latencies: dict[str, RpcLatency]):
+        self._pulse_streamer = pulse_streamer
+        self._latencies = latencies
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._pulse_streamer, name)
+        if not callable(attribute):
+            return attribute
+        latency = self._latencies.setdefault(name, RpcLatency())
+
+        @functools.wraps(attribute)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                latency.record(time.perf_counter() - start)
+
+        return timed
+
+
+# A call to the device over the network takes about a millisecond, so there is no
+# point in polling more often.
+_MIN_POLL_INTERVAL = 1e-3
+_MAX_POLL_INTERVAL = 20e-3
@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+
+from caqtus.types.recoverable_exceptions import InvalidValueError
+from caqtus.shot_compilation.timed_instructions import (
+    Pattern,
+    Concatenated,
+    Repeated,
+)
+from caqtus_devices.pulse_generators.swabian_instruments_pulse_streamer.runtime.encoding import (  # noqa: E501
+    run_length_encode,
+    encode_channels,
+    quantize_analog,
+    ANALOG_RESOLUTION,
+    encode_sequence,
+    collapse_periodic,
+)
+
+DIGITAL_CHANNEL_NUMBER = 8
+CHANNEL_NUMBER = 10
+
+
+def digital_pattern(levels: list[int], analog: float = 0.0) -> Pattern:
+    """Build a pattern where bit i of each level is the state of channel i.
+
+    The analog channels are held at the given value.
+    """
+
+    dtype = np.dtype(
+        [(f"ch {channel}", np.bool_) for channel in range(DIGITAL_CHANNEL_NUMBER)]
+        + [
+            (f"ch {channel}", np.float64)
+            for channel in range(DIGITAL_CHANNEL_NUMBER, CHANNEL_NUMBER)
+        ]
+    )
+    array = np.zeros(len(levels), dtype=dtype)
+    for channel in range(DIGITAL_CHANNEL_NUMBER):
+        array[f"ch {channel}"] = [(level >> channel) & 1 for level in levels]
+    for channel in range(DIGITAL_CHANNEL_NUMBER, CHANNEL_NUMBER):
+        array[f"ch {channel}"] = analog
+    return Pattern.create_without_copy(array)
+
+
+def test_run_length_encode():
+    durations, levels = run_length_encode(
+        np.array([True, True, False, False, False, True])
+    )
+
+    assert durations.tolist() == [2, 3, 1]
+    assert levels.tolist() == [True, False, True]
+
+
+def test_run_length_encode_empty():
+    durations, levels = run_length_encode(np.array([], dtype=np.bool_))
+
+    assert len(durations) == 0
+    assert len(levels) == 0
+
+
+def test_runs_are_merged_across_concatenated_instructions():
+    sequence = Concatenated(
+        digital_pattern([1, 1, 0]),
+        digital_pattern([0, 3]),
+        Repeated(2, digital_pattern([3, 3])),
+    )
+    channel_runs = encode_channels(sequence, CHANNEL_NUMBER)
+
+    durations, levels = channel_runs[0]
+    assert durations.tolist() == [2, 2, 5]
+    assert levels.tolist() == [True, False, True]
+    durations, levels = channel_runs[1]
+    assert durations.tolist() == [4, 5]
+    assert levels.tolist() == [False, True]
+    durations, levels = channel_runs[2]
+    assert durations.tolist() == [9]
+    assert levels.tolist() == [False]
+
+
+def test_repeated_sequence_is_repeated_by_device():
+    encoded = encode_sequence(
+        Repeated(1000, digital_pattern([1, 0, 0])), CHANNEL_NUMBER
+    )
+
+    assert encoded.repetitions == 1000
+    durations, levels = encoded.channel_runs[0]
+    assert durations.tolist() == [1, 2]
+    assert encoded.duration == 3000
+
+
+def test_constant_channel_is_not_tiled():
+    sequence = Concatenated(
+        digital_pattern([2]), Repeated(1000, digital_pattern([3, 2]))
+    )
+    channel_runs = encode_sequence(sequence, CHANNEL_NUMBER).channel_runs
+
+    assert channel_runs[1][0].tolist() == [2001]
+    assert len(channel_runs[0][0]) == 2001
+
+
+def test_number_of_pulses():
+    encoded = encode_sequence(digital_pattern([1, 1, 3, 2, 2, 0]), CHANNEL_NUMBER)
+
+    assert encoded.number_of_pulses() == 4
+    assert encoded.max_number_of_pulses() >= 4
+
+
+def test_periodic_sequence_is_collapsed():
+    encoded = encode_sequence(digital_pattern([1, 2, 2] * 5), CHANNEL_NUMBER)
+    collapsed = collapse_periodic(encoded)
+
+    assert collapsed.repetitions == 5
+    assert collapsed.number_of_pulses() == 2
+    assert collapsed.duration == encoded.duration
+
+
+def test_analog_values_are_quantized_before_encoding():
+    quantized = quantize_analog(
+        np.array([0.5, 0.5 + ANALOG_RESOLUTION / 10, -1.0]), channel=8
+    )
+
+    assert quantized[0] == quantized[1]
+    assert quantized[2] == -1.0
+
+
+def test_analog_channels_are_encoded():
+    sequence = Concatenated(
+        digital_pattern([1, 1], analog=0.25), digital_pattern([1], analog=-0.5)
+    )
+    durations, levels = encode_channels(sequence, CHANNEL_NUMBER)[8]
+
+    assert durations.tolist() == [2, 1]
+    assert np.allclose(levels, [0.25, -0.5], atol=ANALOG_RESOLUTION)
+
+
+def test_analog_values_out_of_range_are_rejected():
+    with pytest.raises(InvalidValueError, match="analog channel 8"):
+        encode_channels(digital_pattern([1], analog=1.5), CHANNEL_NUMBER)
@@ -0,0 +1,99 @@
+import decimal
+import time
+
+import pytest
+
+from caqtus.device.sequencer.trigger import ExternalTriggerStart, TriggerEdge
+from caqtus.shot_compilation.timed_instructions import Concatenated, Repeated
+from caqtus_devices.pulse_generators.swabian_instruments_pulse_streamer.runtime import (  # noqa: E501
+    SwabianPulseStreamer,
+    simulated_pulse_streamer,
+)
+from .test_encoding import digital_pattern
+
+IP_ADDRESS = "127.0.0.1"
+
+
+@pytest.fixture
+def device():
+    simulated_pulse_streamer.reset_simulation()
+    with SwabianPulseStreamer(
+        name="swabian",
+        ip_address=IP_ADDRESS,
+        time_step=decimal.Decimal(1),
+        trigger=ExternalTriggerStart(edge=TriggerEdge.RISING),
+        simulate=True,
+    ) as device:
+        yield device
+
+
+def test_uploaded_pulses(device):
+    sequence = Concatenated(digital_pattern([1, 1, 2]), digital_pattern([2, 0]))
+    with device.program_sequence(sequence).run() as status:
+        simulated_pulse_streamer.send_trigger(IP_ADDRESS)
+        status.block_until_finished()
+
+    upload = simulated_pulse_streamer.get_device(IP_ADDRESS).uploads[-1]
+    assert [pulse[:2] for pulse in upload.pulses] == [(2, 1), (2, 2), (1, 0)]
+    assert upload.n_runs == 1
+
+
+def test_identical_sequence_is_not_uploaded_again(device):
+    sequence = Repeated(100, digital_pattern([1, 0]))
+    for _ in range(3):
+        with device.program_sequence(sequence).run() as status:
+            simulated_pulse_streamer.send_trigger(IP_ADDRESS)
+            status.block_until_finished()
+
+    assert len(simulated_pulse_streamer.get_device(IP_ADDRESS).uploads) == 1
+    assert device.upload_cache_hits == 2
+    assert device.rpc_latencies["stream"].count == 1
+    # With a hardware trigger, a cached shot only needs to rearm the device.
+    assert device.rpc_latencies["rearm"].count == 2
+    assert "hasSequence" not in device.rpc_latencies
+
+
+def test_sequence_is_uploaded_again_after_an_error(device):
+    sequence = Repeated(100, digital_pattern([1, 0]))
+    device.program_sequence(sequence)
+    with pytest.raises(ZeroDivisionError):
+        with device.program_sequence(sequence).run():
+            1 / 0
+    with device.program_sequence(sequence).run() as status:
+        simulated_pulse_streamer.send_trigger(IP_ADDRESS)
+        status.block_until_finished()
+
+    # Interrupting the run forces the final state, which releases the sequence.
+    assert len(simulated_pulse_streamer.get_device(IP_ADDRESS).uploads) == 2
+
+
+def test_released_sequence_is_uploaded_again(device):
+    sequence = digital_pattern([1, 0])
+    device.program_sequence(sequence)
+    simulated_pulse_streamer.get_device(IP_ADDRESS).forceFinal()
+    device.program_sequence(sequence)
+
+    assert len(simulated_pulse_streamer.get_device(IP_ADDRESS).uploads) == 2
+    assert device.upload_cache_hits == 0
+
+
+def test_sequence_waits_for_delayed_trigger(device):
+    sequence = Repeated(100, digital_pattern([1, 0]))
+    for _ in range(2):
+        with device.program_sequence(sequence).run() as status:
+            # The sequence had time to play, but the trigger didn't arrive yet.
+            time.sleep(0.01)
+            assert not status.is_finished()
+
+            simulated_pulse_streamer.send_trigger(IP_ADDRESS)
+            status.block_until_finished()
+            assert status.is_finished()
+
+    assert device.upload_cache_hits == 1
+
+
+def test_memory_overflow(device):
+    simulated_pulse_streamer.get_device(IP_ADDRESS).max_pulses = 2
+
+    with pytest.raises(simulated_pulse_streamer.SimulationError):
+        device.program_sequence(digital_pattern([1, 0, 1]))